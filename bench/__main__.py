@@ -0,0 +1,63 @@
+import json
+import logging
+from pathlib import Path
+from typing import List, Optional
+
+import typer
+
+from . import decode as decode_bench
+from .run import SCENARIOS, compare, run, run_scenario, table
+
+app = typer.Typer()
+
+
+@app.command("list")
+def list_():
+    for name, scenario in SCENARIOS.items():
+        print(f"{name:<20} {scenario.description}")
+
+
+@app.command("run")
+def run_(
+    names: Optional[List[str]] = typer.Argument(None),
+    output: Optional[Path] = typer.Option(None, help="Save the results as JSON."),
+    baseline: Optional[Path] = typer.Option(
+        None, help="Results of a previous run, fail on regressions against it."
+    ),
+    tolerance: float = 0.25,
+    verbose: bool = False,
+):
+    """
+    Run the given scenarios (all of them by default) and print the results.
+    """
+    logging.basicConfig(level=logging.INFO)
+    results = run(names or list(SCENARIOS), verbose)
+    print(table(results))
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2))
+    if baseline is not None:
+        failures = compare(results, json.loads(baseline.read_text()), tolerance)
+        for failure in failures:
+            print("REGRESSION", failure)
+        if failures:
+            raise typer.Exit(1)
+
+
+@app.command()
+def decode(runs: int = 5000):
+    """
+    Microbenchmark of the decoding of workflow runs, see bench/decode.py.
+    """
+    print(decode_bench.table(decode_bench.run(runs)))
+
+
+@app.command(hidden=True)
+def scenario(name: str):
+    """
+    Run one scenario in this process, and print its results as JSON.
+    """
+    print(json.dumps(run_scenario(SCENARIOS[name])))
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,125 @@
+"""
+Microbenchmark of the decoding of GitHub payloads (``src/github_types.py``).
+
+Decodes pages of workflow runs, shaped like the ones GitHub returns (with the
+dozens of keys we drop), with the current decoders and with the previous
+implementation: plain dataclasses, and a ``from_json`` that looked the fields
+up for every key of every object. We report the time per run, and the memory
+the decoded runs take.
+"""
+import time
+import tracemalloc
+from dataclasses import fields, make_dataclass
+from functools import cache
+from typing import Any, Callable, Dict, List
+
+from src.github_types import WorkflowRun, _Base
+
+
+def run_json(i: int) -> Dict[str, Any]:
+    """
+    A workflow run, as listed by ``/repos/<org>/<repo>/actions/runs``.
+    """
+    url = f"https://api.github.com/repos/org/repo/actions/runs/{i}"
+    user = {"login": "someone", "id": 1, "type": "User", "site_admin": False}
+    repository = {"id": 2, "name": "repo", "full_name": "org/repo", "owner": user}
+    return {
+        "id": i,
+        "name": "tests",
+        "node_id": f"WFR_{i}",
+        "head_branch": f"branch-{i % 50}",
+        "head_sha": f"{i:040x}",
+        "path": ".github/workflows/tests.yml",
+        "display_title": f"Pull request {i % 50}",
+        "run_number": i % 1000,
+        "event": "pull_request",
+        "status": "completed",
+        "conclusion": "success",
+        "workflow_id": 3,
+        "check_suite_id": i * 2,
+        "check_suite_node_id": f"CS_{i}",
+        "url": url,
+        "html_url": f"https://github.com/org/repo/actions/runs/{i}",
+        "pull_requests": [],
+        "created_at": "2026-10-18T00:00:00Z",
+        "updated_at": "2026-10-18T00:10:00Z",
+        "actor": user,
+        "run_attempt": 1,
+        "referenced_workflows": [],
+        "run_started_at": "2026-10-18T00:00:00Z",
+        "triggering_actor": user,
+        "jobs_url": f"{url}/jobs",
+        "logs_url": f"{url}/logs",
+        "check_suite_url": f"https://api.github.com/repos/org/repo/check-suites/{i}",
+        "artifacts_url": f"{url}/artifacts",
+        "cancel_url": f"{url}/cancel",
+        "rerun_url": f"{url}/rerun",
+        "previous_attempt_url": None,
+        "workflow_url": "https://api.github.com/repos/org/repo/actions/workflows/3",
+        "head_commit": {"id": f"{i:040x}", "message": "Fix things", "author": user},
+        "repository": repository,
+        "head_repository": repository,
+    }
+
+
+@cache
+def _legacy(cls: type) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Decoder of a dataclass like ``cls``, but without slots, as they were before.
+    """
+    plain = make_dataclass(cls.__name__, [(f.name, f.type) for f in fields(cls)])
+
+    def from_json(data):
+        f_data = {}
+        fields_names = [f.name for f in fields(plain)]
+        for key in data.keys():
+            if key in fields_names:
+                f = [f for f in fields(plain) if f.name == key][0]
+                if isinstance(f.type, type) and issubclass(f.type, _Base):
+                    f_data[f.name] = _legacy(f.type)(data[f.name])
+                else:
+                    f_data[f.name] = data[f.name]
+        return plain(**f_data)
+
+    return from_json
+
+
+def _measure(decode_page: Callable[[List[Dict]], List], pages: List[List[Dict]]):
+    begin = time.perf_counter()
+    for page in pages:
+        decode_page(page)
+    elapsed = time.perf_counter() - begin
+    tracemalloc.start()
+    kept = [decode_page(page) for page in pages]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return elapsed, size
+
+
+def run(n_runs: int, per_page: int = 100) -> List[Dict[str, Any]]:
+    items = [run_json(i) for i in range(n_runs)]
+    pages = [items[i : i + per_page] for i in range(0, n_runs, per_page)]
+    legacy = _legacy(WorkflowRun)
+    results = []
+    for name, decode_page in [
+        ("legacy", lambda page: [legacy(x) for x in page]),
+        ("from_json", lambda page: [WorkflowRun.from_json(x) for x in page]),
+        ("from_json_list", WorkflowRun.from_json_list),
+    ]:
+        elapsed, size = _measure(decode_page, pages)
+        results.append(
+            {"decoder": name, "us_per_run": elapsed / n_runs * 1e6, "bytes": size}
+        )
+    return results
+
+
+def table(results: List[Dict[str, Any]]) -> str:
+    lines = [f"{'decoder':<16} {'per run':>10} {'memory':>10} {'speedup':>8}"]
+    base = results[0]["us_per_run"]
+    for r in results:
+        lines.append(
+            f"{r['decoder']:<16} {r['us_per_run']:>8.2f}us "
+            f"{r['bytes'] / 1024:>8.0f}kB {base / r['us_per_run']:>7.1f}x"
+        )
+    return "\n".join(lines)
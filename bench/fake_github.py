@@ -0,0 +1,334 @@
+"""
+Local stand-in for the parts of the GitHub API the app uses.
+
+It serves, for a set of pull requests generated up front:
+
+- ``GET /app/installations``, ``/repos/<org>/<repo>/installation`` and
+  ``POST /app/installations/<id>/access_tokens``
+- ``GET /repos/<org>/<repo>/pulls`` and ``/pulls/<number>``
+- ``GET /repos/<org>/<repo>/actions/runs`` (``head_sha``, ``branch`` and
+  ``event`` filters, paginated), ``/actions/runs/<id>`` and
+  ``/actions/runs/<id>/artifacts``
+- ``GET /download/<artifact id>``, the artifact archives, ``Range`` included.
+
+JSON responses have an ETag and rate limit headers, like GitHub's, and
+conditional requests get a 304. Every call is counted by endpoint, see
+``GET /_bench/calls`` and ``POST /_bench/reset``.
+
+It runs in its own process (``start``), so that serving archives does not
+compete with the app for the GIL.
+"""
+import hashlib
+import json
+import multiprocessing
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+
+from .synthetic import artifact_zip
+
+
+@dataclass
+class FakeRun:
+    id: int
+    head_sha: str
+    head_branch: str
+    event: str
+    # artifact id -> archive
+    artifacts: Dict[int, bytes] = field(default_factory=dict)
+
+
+@dataclass
+class FakePull:
+    number: int
+    head_sha: str
+    head_ref: str
+    base_ref: str = "main"
+
+
+@dataclass
+class FakeRepo:
+    org: str
+    repo: str
+    pulls: Dict[int, FakePull] = field(default_factory=dict)
+    runs: List[FakeRun] = field(default_factory=list)
+
+
+@dataclass
+class Spec:
+    """
+    What to generate: one PR with ``runs`` workflow runs, each with one pytest
+    artifact of ``width`` report files of ``n_tests`` tests, plus as many push
+    runs on the base branch.
+    """
+
+    org: str = "bench"
+    repo: str = "viewer"
+    number: int = 1
+    n_tests: int = 2000
+    width: int = 4
+    runs: int = 2
+    # runs of other commits that show up when crawling.
+    noise_runs: int = 20
+    # ids of runs and artifacts start here, use a new one to get cold caches.
+    first_id: int = 1
+    # bytes of other files next to the reports in each artifact.
+    extra_bytes: int = 0
+
+
+def build(spec: Spec) -> FakeRepo:
+    fake = FakeRepo(spec.org, spec.repo)
+    ids = iter(range(spec.first_id, spec.first_id + 10**6))
+    head_sha = hashlib.sha1(f"head-{spec.first_id}".encode()).hexdigest()
+    fake.pulls[spec.number] = FakePull(spec.number, head_sha, f"pr-{spec.number}")
+
+    for i in range(spec.runs):
+        run = FakeRun(next(ids), head_sha, f"pr-{spec.number}", "pull_request")
+        run.artifacts[next(ids)] = artifact_zip(
+            spec.n_tests, spec.width, seed=i, extra=spec.extra_bytes
+        )
+        fake.runs.append(run)
+    for i in range(spec.runs):
+        sha = hashlib.sha1(f"base-{spec.first_id}-{i}".encode()).hexdigest()
+        run = FakeRun(next(ids), sha, "main", "push")
+        run.artifacts[next(ids)] = artifact_zip(
+            spec.n_tests, spec.width, seed=100 + i, extra=spec.extra_bytes
+        )
+        fake.runs.append(run)
+    for i in range(spec.noise_runs):
+        sha = hashlib.sha1(f"noise-{spec.first_id}-{i}".encode()).hexdigest()
+        fake.runs.append(FakeRun(next(ids), sha, f"other-{i}", "pull_request"))
+    return fake
+
+
+class Handler(BaseHTTPRequestHandler):
+    # set on the subclass made by serve()
+    fake: FakeRepo
+    calls: Counter
+    lock: Lock
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def base(self) -> str:
+        return f"http://{self.headers['Host']}"
+
+    def _count(self, endpoint: str) -> None:
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def _send(self, status: int, body: bytes, content_type: str, **headers) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data: Any) -> None:
+        body = json.dumps(data).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        rate = {
+            "X_RateLimit_Limit": "5000",
+            "X_RateLimit_Remaining": "4999",
+            "X_RateLimit_Reset": str(int(time.time()) + 3600),
+        }
+        if self.headers.get("If-None-Match") == etag:
+            self._count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            for name, value in rate.items():
+                self.send_header(name.replace("_", "-"), value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send(200, body, "application/json; charset=utf-8", ETag=etag, **rate)
+
+    def _not_found(self) -> None:
+        self._send(404, b'{"message": "Not Found"}', "application/json")
+
+    def _run_json(self, run: FakeRun) -> Dict[str, Any]:
+        url = (
+            f"{self.base}/repos/{self.fake.org}/{self.fake.repo}/actions/runs/{run.id}"
+        )
+        return {
+            "id": run.id,
+            "name": "tests",
+            "head_branch": run.head_branch,
+            "head_sha": run.head_sha,
+            "event": run.event,
+            "status": "completed",
+            "conclusion": "success",
+            "url": url,
+            "html_url": url,
+            "created_at": "2026-10-18T00:00:00Z",
+            "updated_at": "2026-10-18T00:10:00Z",
+            "artifacts_url": f"{url}/artifacts",
+        }
+
+    def _artifact_json(self, run: FakeRun, artifact_id: int) -> Dict[str, Any]:
+        return {
+            "id": artifact_id,
+            "name": "upload pytest timing reports as json",
+            "size_in_bytes": len(run.artifacts[artifact_id]),
+            "archive_download_url": f"{self.base}/download/{artifact_id}",
+            "workflow_run": {
+                "id": run.id,
+                "head_branch": run.head_branch,
+                "head_sha": run.head_sha,
+            },
+        }
+
+    def _pull_json(self, pull: FakePull) -> Dict[str, Any]:
+        return {
+            "number": pull.number,
+            "title": f"Benchmark PR {pull.number}",
+            "head": {"ref": pull.head_ref, "sha": pull.head_sha},
+            "base": {"ref": pull.base_ref, "sha": "0" * 40},
+        }
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if re.fullmatch(r"/app/installations/\d+/access_tokens", path):
+            self._count("access_tokens")
+            expires = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600)
+            )
+            return self._json({"token": "fake-token", "expires_at": expires})
+        if path == "/_bench/reset":
+            with self.lock:
+                self.calls.clear()
+            return self._send(200, b"{}", "application/json")
+        self._not_found()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path, query = url.path, {k: v[0] for k, v in parse_qs(url.query).items()}
+        prefix = f"/repos/{self.fake.org}/{self.fake.repo}"
+        runs = {run.id: run for run in self.fake.runs}
+
+        if path == "/_bench/calls":
+            with self.lock:
+                return self._send(
+                    200, json.dumps(self.calls).encode(), "application/json"
+                )
+        if path == "/app/installations":
+            self._count("installations")
+            return self._json([{"id": 1, "account": {"login": self.fake.org}}])
+        if path == f"{prefix}/installation":
+            self._count("installation")
+            return self._json({"id": 1, "account": {"login": self.fake.org}})
+
+        if path == f"{prefix}/pulls":
+            self._count("pulls")
+            return self._json([self._pull_json(p) for p in self.fake.pulls.values()])
+        m = re.fullmatch(rf"{prefix}/pulls/(\d+)", path)
+        if m:
+            self._count("pull")
+            pull = self.fake.pulls.get(int(m[1]))
+            return (
+                self._not_found() if pull is None else self._json(self._pull_json(pull))
+            )
+
+        if path == f"{prefix}/actions/runs":
+            self._count("runs")
+            selected = [
+                run
+                for run in reversed(self.fake.runs)
+                if query.get("head_sha", run.head_sha) == run.head_sha
+                and query.get("branch", run.head_branch) == run.head_branch
+                and query.get("event", run.event) == run.event
+            ]
+            per_page = int(query.get("per_page", 30))
+            page = int(query.get("page", 1))
+            return self._json(
+                {
+                    "total_count": len(selected),
+                    "workflow_runs": [
+                        self._run_json(run)
+                        for run in selected[(page - 1) * per_page : page * per_page]
+                    ],
+                }
+            )
+        m = re.fullmatch(rf"{prefix}/actions/runs/(\d+)(/artifacts)?", path)
+        if m:
+            run = runs.get(int(m[1]))
+            if run is None:
+                return self._not_found()
+            if m[2]:
+                self._count("artifacts")
+                return self._json(
+                    {
+                        "total_count": len(run.artifacts),
+                        "artifacts": [
+                            self._artifact_json(run, a) for a in run.artifacts
+                        ],
+                    }
+                )
+            self._count("run")
+            return self._json(self._run_json(run))
+
+        m = re.fullmatch(r"/download/(\d+)", path)
+        if m:
+            for run in self.fake.runs:
+                if int(m[1]) in run.artifacts:
+                    return self._archive(run.artifacts[int(m[1])])
+        self._not_found()
+
+    def _archive(self, body: bytes) -> None:
+        m = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if m is None:
+            self._count("download")
+            return self._send(200, body, "application/zip")
+        self._count("download_range")
+        if m[1]:
+            start, end = int(m[1]), min(int(m[2] or len(body) - 1), len(body) - 1)
+        else:
+            start, end = max(0, len(body) - int(m[2])), len(body) - 1
+        self._send(
+            206,
+            body[start : end + 1],
+            "application/zip",
+            Content_Range=f"bytes {start}-{end}/{len(body)}",
+        )
+
+
+def serve(spec: Spec, ready) -> None:
+    fake = build(spec)
+    handler = type(
+        "BoundHandler", (Handler,), {"fake": fake, "calls": Counter(), "lock": Lock()}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start(spec: Spec) -> Tuple[multiprocessing.Process, str]:
+    """
+    Start the fake API in a new process, and return it with its base url, once
+    it is ready to serve.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(spec, child), daemon=True)
+    process.start()
+    port = parent.recv()
+    return process, f"http://127.0.0.1:{port}"
+
+
+def calls(base_url: str) -> Dict[str, int]:
+    with urlopen(f"{base_url}/_bench/calls") as resp:
+        return json.load(resp)
+
+
+def reset(base_url: str) -> None:
+    urlopen(Request(f"{base_url}/_bench/reset", data=b"", method="POST")).close()
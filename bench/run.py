@@ -0,0 +1,311 @@
+"""
+End to end benchmark scenarios.
+
+Each scenario runs in its own process, so that peak RSS and caches are its
+own: it starts the fake GitHub API (fake_github.py) with freshly generated
+artifacts, imports the app pointed at it, serves it with hypercorn on a local
+port, and opens the ``/api/gh/...`` event stream from as many simulated
+viewers as the scenario says.
+
+For each scenario we report:
+
+- ``first_event_ms``: median time from opening the stream to the first event
+- ``total_ms``: time until every viewer has all the data
+- ``rss_peak_mb``: peak RSS of the app process, ``workers_rss_peak_mb`` of its
+  parse workers
+- ``github_calls``: calls to the fake API while measuring, by endpoint
+
+Ids of the generated runs and artifacts are new on every run, so the postgres
+caches are cold, unless the scenario views the PR once before measuring. The
+scenarios use a database of their own (``bench_database``), and keep their
+tokens and artifacts in a temporary directory, not those of the dev setup.
+"""
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from .fake_github import Spec, calls, reset, start
+
+ROOT = Path(__file__).parent.parent
+# created on the server of the dev database for the duration of a run.
+BENCH_DB = os.environ.get("BENCH_POSTGRES_DB", "viewer_bench")
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    spec: Spec = field(default_factory=Spec)
+    # simultaneous viewers of the PR
+    viewers: int = 1
+    query: str = ""
+    # view the PR once before measuring
+    warm: bool = False
+
+
+SCENARIOS = {
+    s.name: s
+    for s in [
+        Scenario("cold_small", "2k tests x 4 files x 2 runs, nothing cached"),
+        Scenario(
+            "cold_large",
+            "20k tests x 12 files x 2 runs, nothing cached",
+            Spec(n_tests=20000, width=12),
+        ),
+        Scenario(
+            "warm_large",
+            "cold_large, viewed a second time",
+            Spec(n_tests=20000, width=12),
+            warm=True,
+        ),
+        Scenario(
+            "stream_compact",
+            "cold_large, as the page requests it, compact tables included",
+            Spec(n_tests=20000, width=12),
+            query="?mode=stream&format=compact",
+        ),
+        Scenario(
+            "bundled_files",
+            "cold_small, with 50MB of other files in each artifact",
+            Spec(extra_bytes=50 * 1024**2),
+        ),
+        Scenario(
+            "concurrent_viewers",
+            "cold_large, opened by 10 viewers at once",
+            Spec(n_tests=20000, width=12),
+            viewers=10,
+        ),
+    ]
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _app_key() -> bytes:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    )
+
+
+async def _view(client, url: str) -> Dict[str, float]:
+    """
+    Read the event stream of one viewer, fetching the compact tables it points
+    to, like the page does.
+    """
+    import trio
+
+    begin = time.perf_counter()
+    first = None
+    async with trio.open_nursery() as nursery:
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if first is None:
+                    first = time.perf_counter() - begin
+                data = json.loads(line[len("data:") :])
+                if "error" in data:
+                    raise RuntimeError(data["error"])
+                if "compact" in data:
+                    nursery.start_soon(client.get, data["compact"])
+    return {"first_event": first or 0.0, "total": time.perf_counter() - begin}
+
+
+def run_scenario(scenario: Scenario) -> Dict[str, Any]:
+    """
+    Run one scenario in this process, see the module docstring. Must be called
+    before the app is imported.
+    """
+    tmp = Path(tempfile.mkdtemp(prefix=f"bench-{scenario.name}-"))
+    spec = replace(scenario.spec, first_id=int(time.time() * 1000) % 10**12)
+    fake, api = start(spec)
+    os.environ.update(
+        APP_ID="1",
+        PEM64=b64encode(_app_key()).decode(),
+        GITHUB_API_URL=api,
+        ARTIFACT_DIR=str(tmp / "artifacts"),
+        AUTH_TOKEN_FILE=str(tmp / "github_token.json"),
+    )
+
+    import httpx
+    import trio
+    from hypercorn.config import Config
+    from hypercorn.trio import serve
+
+    from src.app import PARSER, app
+
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    url = f"{base}/api/gh/{spec.org}/{spec.repo}/pull/{spec.number}{scenario.query}"
+    result: Dict[str, Any] = {"scenario": scenario.name}
+
+    async def main():
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        shutdown = trio.Event()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(
+                partial(serve, app, config, shutdown_trigger=shutdown.wait)
+            )
+            async with httpx.AsyncClient(base_url=base, timeout=600) as client:
+                while True:
+                    try:
+                        await client.get("/index.js")
+                        break
+                    except httpx.TransportError:
+                        await trio.sleep(0.05)
+                result["startup_calls"] = calls(api)
+                if scenario.warm:
+                    await _view(client, url)
+                reset(api)
+
+                views: List[Dict[str, float]] = []
+
+                async def viewer():
+                    views.append(await _view(client, url))
+
+                begin = time.perf_counter()
+                async with trio.open_nursery() as viewers:
+                    for _ in range(scenario.viewers):
+                        viewers.start_soon(viewer)
+                result["total_ms"] = (time.perf_counter() - begin) * 1000
+                result["first_event_ms"] = (
+                    statistics.median(v["first_event"] for v in views) * 1000
+                )
+                result["github_calls"] = calls(api)
+            shutdown.set()
+
+    trio.run(main)
+    PARSER.shutdown()
+    # only children that have exited are accounted for.
+    result["rss_peak_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["workers_rss_peak_mb"] = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+    fake.terminate()
+    return result
+
+
+@contextmanager
+def bench_database() -> Iterator[str]:
+    """
+    Create BENCH_DB afresh, with the migrations applied, on the server of the
+    database of ``.env``, and drop it afterwards.
+    """
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv(ROOT / ".env")
+    if BENCH_DB == os.environ["POSTGRES_DB"]:
+        raise ValueError(f"BENCH_POSTGRES_DB must not be the dev database {BENCH_DB}")
+    params = dict(
+        host=os.environ["POSTGRES_HOST"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        port=os.environ["POSTGRES_PORT"],
+    )
+
+    def admin(sql: str) -> None:
+        conn = psycopg2.connect(dbname=os.environ["POSTGRES_DB"], **params)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+        finally:
+            conn.close()
+
+    admin(f'DROP DATABASE IF EXISTS "{BENCH_DB}"')
+    admin(f'CREATE DATABASE "{BENCH_DB}"')
+    try:
+        conn = psycopg2.connect(dbname=BENCH_DB, **params)
+        try:
+            with conn, conn.cursor() as cursor:
+                for migration in sorted(ROOT.glob("migrations/*/up.sql")):
+                    cursor.execute(migration.read_text())
+        finally:
+            conn.close()
+        yield BENCH_DB
+    finally:
+        admin(f'DROP DATABASE IF EXISTS "{BENCH_DB}"')
+
+
+def run(names: List[str], verbose: bool = False) -> List[Dict[str, Any]]:
+    """
+    Run the scenarios, each in a new process, against a new database.
+    """
+    results = []
+    with bench_database() as db:
+        for name in names:
+            scenario = SCENARIOS[name]
+            logging.info("Running %s: %s", name, scenario.description)
+            proc = subprocess.run(
+                [sys.executable, "-m", "bench", "scenario", name],
+                cwd=ROOT,
+                env=dict(os.environ, PYTHONPATH=str(ROOT), POSTGRES_DB=db),
+                stdout=subprocess.PIPE,
+                stderr=None if verbose else subprocess.DEVNULL,
+                text=True,
+                check=True,
+            )
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    """
+    Regressions of ``results`` compared to ``baseline``: latencies and peak RSS
+    more than ``tolerance`` (relative) above, and any additional GitHub call.
+    """
+    before = {r["scenario"]: r for r in baseline}
+    failures = []
+    for r in results:
+        b: Optional[Dict[str, Any]] = before.get(r["scenario"])
+        if b is None:
+            continue
+        for key in ("first_event_ms", "total_ms", "rss_peak_mb"):
+            if r[key] > b[key] * (1 + tolerance):
+                failures.append(f"{r['scenario']}: {key} {b[key]:.0f} -> {r[key]:.0f}")
+        n, m = sum(b["github_calls"].values()), sum(r["github_calls"].values())
+        if m > n:
+            failures.append(f"{r['scenario']}: github calls {n} -> {m}")
+    return failures
+
+
+def table(results: List[Dict[str, Any]]) -> str:
+    lines = [
+        f"{'scenario':<20} {'first event':>12} {'total':>10} {'rss':>8} "
+        f"{'workers':>8} {'gh calls':>9}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<20} {r['first_event_ms']:>10.0f}ms "
+            f"{r['total_ms']:>8.0f}ms {r['rss_peak_mb']:>6.0f}MB "
+            f"{r['workers_rss_peak_mb']:>6.0f}MB {sum(r['github_calls'].values()):>9}"
+        )
+    return "\n".join(lines)
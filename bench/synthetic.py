@@ -0,0 +1,127 @@
+"""
+Synthetic pytest-json-report files.
+
+Reports have the same shape as the ones produced by pytest-json-report (the
+fields we read, plus the usual ones we skip, so that parsing does a realistic
+amount of work), with nodeids drawn from a few typical layouts, and durations
+from a long tailed distribution: most tests are fast, a few are very slow.
+
+Everything is derived from a seed, so the same arguments give the same bytes.
+"""
+import io
+import json
+import random
+from typing import Any, Dict, List, Sequence
+from zipfile import ZIP_DEFLATED, ZipFile
+
+# nodeid layouts, mixed in equal parts by default.
+SHAPES = ("function", "class", "param")
+
+PYTHONS = ("3.8", "3.9", "3.10", "3.11", "3.12")
+OSES = ("ubuntu-latest", "macos-latest", "windows-latest")
+
+
+def nodeids(n: int, shapes: Sequence[str] = SHAPES, seed: int = 0) -> List[str]:
+    """
+    ``n`` unique nodeids, spread over ~n/50 test files in a package tree.
+    """
+    rng = random.Random(seed)
+    n_files = max(1, n // 50)
+    files = [
+        f"pkg/{rng.choice(['core', 'io', 'utils', 'api'])}/tests/test_mod{i}.py"
+        for i in range(n_files)
+    ]
+    result = []
+    for i in range(n):
+        file = files[i % n_files]
+        shape = shapes[i % len(shapes)]
+        if shape == "function":
+            result.append(f"{file}::test_func_{i}")
+        elif shape == "class":
+            result.append(f"{file}::TestCase{i % 7}::test_method_{i}")
+        elif shape == "param":
+            params = "-".join(
+                rng.choice(["a", "b", "int64", "float32", "None"]) for _ in range(3)
+            )
+            result.append(f"{file}::test_param_{i // 4}[{params}-{i}]")
+        else:
+            raise ValueError(f"Unknown nodeid shape {shape!r}")
+    return result
+
+
+def _duration(rng: random.Random, scale: float) -> float:
+    return rng.lognormvariate(-6, 1.5) * scale
+
+
+def report(ids: Sequence[str], seed: int = 0, slowdown: float = 1.0) -> Dict[str, Any]:
+    """
+    A report with one test per nodeid. Durations of the same nodeid are
+    similar across seeds, times ``slowdown``.
+    """
+    rng = random.Random(seed)
+    tests = []
+    for i, nodeid in enumerate(ids):
+        # stable per test, so that matrix files and runs look alike.
+        base = random.Random(i).lognormvariate(-5, 2)
+        outcome = "skipped" if i % 97 == 0 else "passed"
+        test: Dict[str, Any] = {
+            "nodeid": nodeid,
+            "lineno": 10 + i % 500,
+            "outcome": outcome,
+            "keywords": [nodeid.rsplit("::", 1)[-1], "tests", "pkg", ""],
+            "setup": {"duration": _duration(rng, 1), "outcome": "passed"},
+            "teardown": {"duration": _duration(rng, 1), "outcome": "passed"},
+        }
+        if outcome == "passed":
+            test["call"] = {
+                "duration": base * slowdown * rng.uniform(0.9, 1.1),
+                "outcome": "passed",
+            }
+        else:
+            test["setup"]["longrepr"] = (nodeid, 12, "Skipped: not on this platform")
+        tests.append(test)
+    return {
+        "created": 1700000000.0 + seed,
+        "duration": sum(t.get("call", {}).get("duration", 0) for t in tests),
+        "exitcode": 0,
+        "root": "/home/runner/work/pkg/pkg",
+        "environment": {"Python": "3.11.7", "Platform": "Linux-6.5.0-x86_64"},
+        "summary": {"passed": len(tests), "total": len(tests), "collected": len(tests)},
+        "collectors": [],
+        "tests": tests,
+    }
+
+
+def matrix(width: int) -> List[str]:
+    """
+    Report file names for a test matrix of ``width`` entries.
+    """
+    return [
+        f"report-{PYTHONS[i % len(PYTHONS)]}-{OSES[i // len(PYTHONS) % len(OSES)]}"
+        f"{'-' + str(i) if i >= len(PYTHONS) * len(OSES) else ''}.json"
+        for i in range(width)
+    ]
+
+
+def artifact_zip(
+    n_tests: int,
+    width: int,
+    shapes: Sequence[str] = SHAPES,
+    seed: int = 0,
+    slowdown: float = 1.0,
+    extra: int = 0,
+) -> bytes:
+    """
+    An artifact archive with one report per matrix entry, as uploaded by
+    ``actions/upload-artifact``, and ``extra`` bytes of other files, which
+    don't compress, in the middle of them.
+    """
+    ids = nodeids(n_tests, shapes, seed=0)
+    names = matrix(width)
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_DEFLATED) as z:
+        for i, name in enumerate(names):
+            z.writestr(name, json.dumps(report(ids, seed * 1000 + i, slowdown)))
+            if extra and i == len(names) // 2:
+                z.writestr("coverage.db", random.Random(seed).randbytes(extra))
+    return buffer.getvalue()
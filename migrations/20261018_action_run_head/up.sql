@@ -0,0 +1,5 @@
+-- head of each run, so that the known runs of a PR head are found without
+-- asking GitHub about every run of the PR. NULL for runs pinged by the CLI,
+-- which only knows their id.
+ALTER TABLE action_run ADD COLUMN head_sha TEXT;
+CREATE INDEX action_run_head ON action_run (organization, repo, pull_number, head_sha);
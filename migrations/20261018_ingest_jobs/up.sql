@@ -0,0 +1,21 @@
+-- ingestions queued by webhooks, run ahead of views by background workers,
+-- see src/jobs.py. One row per PR head: queuing it again while it waits
+-- only bumps it.
+CREATE TABLE ingest_job (
+	id BIGSERIAL PRIMARY KEY,
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	pull_number INTEGER NOT NULL,
+	head_ref TEXT NOT NULL,
+	head_sha TEXT NOT NULL,
+	-- time of the latest event for this head, most recent ones go first
+	enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+	run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+	-- set while a worker has it, past it the job is up for grabs again
+	locked_until TIMESTAMPTZ,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	last_error TEXT,
+
+	CONSTRAINT ingest_job_unique UNIQUE (organization, repo, pull_number, head_sha)
+);
+CREATE INDEX ingest_job_next ON ingest_job (enqueued_at DESC);
@@ -0,0 +1,28 @@
+-- when each action run was first recorded, to list runs and pulls by recency.
+-- existing runs all get the time of the migration.
+ALTER TABLE action_run ADD COLUMN seen_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+-- listing indexes, one per set of filters, see store.keyset: equality
+-- filters first, then the sort columns, so that each page is a range scan.
+CREATE INDEX action_run_recent ON action_run (seen_at, organization, repo, run_id, pull_number);
+CREATE INDEX action_run_org_recent ON action_run (organization, seen_at, repo, run_id, pull_number);
+CREATE INDEX action_run_repo_recent ON action_run (organization, repo, seen_at, run_id, pull_number);
+
+-- one row per pull request, bumped when a new run of it is recorded, so that
+-- listing the most recent pulls does not go through all their runs.
+CREATE TABLE pull_request (
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	pull_number INTEGER NOT NULL,
+	last_seen_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+	PRIMARY KEY (organization, repo, pull_number)
+);
+CREATE INDEX pull_request_recent ON pull_request (last_seen_at, organization, repo, pull_number);
+CREATE INDEX pull_request_org_recent ON pull_request (organization, last_seen_at, repo, pull_number);
+CREATE INDEX pull_request_repo_recent ON pull_request (organization, repo, last_seen_at, pull_number);
+
+INSERT INTO pull_request (organization, repo, pull_number, last_seen_at)
+SELECT organization, repo, pull_number, max(seen_at)
+FROM action_run
+GROUP BY organization, repo, pull_number;
@@ -0,0 +1,6 @@
+-- artifacts whose tables are all in report_table, including the ones without
+-- any report, which have no rows there.
+CREATE TABLE processed_artifact (
+	artifact_id BIGINT PRIMARY KEY
+);
+INSERT INTO processed_artifact SELECT DISTINCT artifact_id FROM report_table;
@@ -0,0 +1,20 @@
+CREATE TABLE report_table (
+	artifact_id BIGINT NOT NULL,
+	member TEXT NOT NULL,
+	-- compacted table, a JSON list of [nodeid, call, setup, teardown], kept as
+	-- text so it can be streamed as is
+	comp JSON NOT NULL,
+
+	PRIMARY KEY (artifact_id, member)
+);
+
+CREATE TABLE head_summary (
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	head_sha TEXT NOT NULL,
+	artifact_ids BIGINT[] NOT NULL,
+	-- number of tests: rows of the comp tables of the artifacts, not characters
+	n_tests INTEGER NOT NULL,
+
+	PRIMARY KEY (organization, repo, head_sha)
+);
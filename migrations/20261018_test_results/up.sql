@@ -0,0 +1,37 @@
+-- interned nodeids, nodeids can be longer than what a btree index accepts,
+-- so they are looked up by their md5.
+CREATE TABLE nodeid (
+	id BIGSERIAL PRIMARY KEY,
+	hash UUID NOT NULL UNIQUE,
+	nodeid TEXT NOT NULL
+);
+
+-- one per report file (matrix entry) in an artifact
+CREATE TABLE report_file (
+	id BIGSERIAL PRIMARY KEY,
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	run_id BIGINT NOT NULL,
+	head_branch TEXT NOT NULL,
+	head_sha TEXT NOT NULL,
+	artifact_id BIGINT NOT NULL,
+	member TEXT NOT NULL,
+	ingested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+	CONSTRAINT report_file_unique UNIQUE (artifact_id, member)
+);
+CREATE INDEX report_file_head_sha ON report_file (organization, repo, head_sha);
+CREATE INDEX report_file_head_branch ON report_file (organization, repo, head_branch, ingested_at DESC);
+
+-- no foreign keys: rows are only written by the bulk ingestion, which
+-- resolves both ids itself, and per row constraint triggers would dominate
+-- its cost.
+CREATE TABLE test_result (
+	report_file_id BIGINT NOT NULL,
+	nodeid_id BIGINT NOT NULL,
+	call REAL NOT NULL,
+	setup REAL NOT NULL,
+	teardown REAL NOT NULL
+);
+CREATE INDEX test_result_report_file ON test_result (report_file_id);
+CREATE INDEX test_result_nodeid ON test_result (nodeid_id);
@@ -0,0 +1,27 @@
+-- per branch baseline of each test, from the test_result rows of its most
+-- recent completed runs, recomputed as a whole when they change.
+CREATE TABLE baseline_state (
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	branch TEXT NOT NULL,
+	run_ids BIGINT[] NOT NULL,
+	computed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+	PRIMARY KEY (organization, repo, branch)
+);
+
+CREATE TABLE baseline (
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	branch TEXT NOT NULL,
+	member TEXT NOT NULL,
+	nodeid_id BIGINT NOT NULL,
+	-- setup + call + teardown duration over the runs
+	n INTEGER NOT NULL,
+	mean REAL NOT NULL,
+	std REAL NOT NULL,
+
+	PRIMARY KEY (organization, repo, branch, member, nodeid_id)
+);
+
+CREATE INDEX report_file_run_id ON report_file (run_id);
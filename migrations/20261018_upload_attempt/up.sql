@@ -0,0 +1,6 @@
+-- a re-run uploads its reports under the same name as the previous attempt,
+-- so uploads are kept per attempt, and only the last one is used.
+ALTER TABLE report_upload ADD COLUMN run_attempt INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE report_upload DROP CONSTRAINT report_upload_unique;
+ALTER TABLE report_upload ADD CONSTRAINT report_upload_unique
+	UNIQUE (organization, repo, run_id, run_attempt, name);
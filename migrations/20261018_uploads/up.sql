@@ -0,0 +1,16 @@
+-- comp tables uploaded by the CLI from the CI job itself, instead of being
+-- downloaded from the artifacts of the run. Their tables are kept in
+-- report_table under the negated id of the upload, which can not collide
+-- with a GitHub artifact id.
+CREATE TABLE report_upload (
+	id BIGSERIAL PRIMARY KEY,
+	organization TEXT NOT NULL,
+	repo TEXT NOT NULL,
+	run_id BIGINT NOT NULL,
+	head_branch TEXT NOT NULL,
+	head_sha TEXT NOT NULL,
+	name TEXT NOT NULL,
+	uploaded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+	CONSTRAINT report_upload_unique UNIQUE (organization, repo, run_id, name)
+);
@@ -1,4 +1,9 @@
 """
-
+Settings are read from the environment when modules are imported, so the
+``.env`` file is loaded here, before any of them.
 """
+from dotenv import load_dotenv
+
+load_dotenv()
+
 __version__ = "0.0.1"
@@ -1,7 +1,7 @@
 import typer
-import requests
 import os
 from pathlib import Path
+from typing import List, Optional
 
 app = typer.Typer()
 
@@ -38,6 +38,21 @@ def info():
         print("it does not seem we are in a github pull_request run...")
 
 
+@app.command()
+def upload(
+    reports: List[Path],
+    name: Optional[str] = None,
+    url: str = typer.Option(BASE_URL, envvar="PYTEST_VIEWER_URL"),
+):
+    """
+    Compact pytest-json-report files and upload them for the current run, see
+    upload.py, which other repositories run on their own.
+    """
+    from .upload import upload
+
+    upload(reports, url, name)
+
+
 @app.command()
 def ping(name: str, formal: bool = False):
     print(f"Bye {name}!")
@@ -0,0 +1,173 @@
+"""
+Server side aggregation of ``comp`` tables.
+
+Rather than shipping every row to the browser, the tables of all the matrix
+files of a PR are loaded in flat numpy arrays, and statistics across matrix
+files are computed for all nodeids (or test files) at once, with sorts and
+reductions over group boundaries instead of python loops.
+
+For a nodeid, the samples are its setup+call+teardown time in each matrix
+file; for a test file, the samples are the sum of this over all its tests, in
+each matrix file.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .reports import CompItem
+
+# durations columns, in the order of the comp tables.
+KINDS = ("call", "setup", "teardown")
+STATS = ("min", "median", "p95", "max")
+
+
+@dataclass
+class Frame:
+    """
+    All the rows of a PR, one per (nodeid, matrix file).
+    """
+
+    nodeids: np.ndarray  # unique nodeids
+    index: Dict[str, int]  # nodeid -> index in nodeids
+    files: List[str]  # matrix file names
+    node: np.ndarray  # index in nodeids, per row
+    file: np.ndarray  # index in files, per row
+    durations: np.ndarray  # (rows, 3), call, setup, teardown
+
+    @classmethod
+    def from_tables(cls, tables: Dict[str, List[CompItem]]) -> "Frame":
+        files = list(tables)
+        index: Dict[str, int] = {}
+        node = np.fromiter(
+            (
+                index.setdefault(item[0], len(index))
+                for comp in tables.values()
+                for item in comp
+            ),
+            dtype=np.intp,
+        )
+        file = np.repeat(
+            np.arange(len(files)), [len(comp) for comp in tables.values()]
+        )
+        durations = np.array(
+            [item[1:] for comp in tables.values() for item in comp], dtype=np.float64
+        ).reshape(-1, 3)
+        nodeids = np.array(list(index), dtype=object)
+        return cls(nodeids, index, files, node, file, durations)
+
+    def test_files(self) -> np.ndarray:
+        """
+        Test file (the part before ``::``) of each unique nodeid.
+        """
+        return np.array([n.split("::", 1)[0] for n in self.nodeids], dtype=object)
+
+
+def _quantile(values, starts, counts, q: float) -> np.ndarray:
+    # same as numpy's default "linear" method, for each group of sorted values.
+    pos = starts + (counts - 1) * q
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, starts + counts - 1)
+    frac = pos - lo
+    return values[lo] * (1 - frac) + values[hi] * frac
+
+
+def group_stats(group: np.ndarray, durations: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Statistics of the total duration of each group of rows, and the mean split
+    between call, setup and teardown.
+
+    Returned arrays are indexed by the unique values of ``group``, given in
+    ``"group"``.
+    """
+    if len(group) == 0:
+        return {name: np.zeros(0) for name in ("group", "count") + STATS + KINDS}
+    total = durations.sum(axis=1)
+    order = np.lexsort((total, group))
+    group, total, durations = group[order], total[order], durations[order]
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    counts = np.diff(np.r_[starts, len(group)])
+    stats = {
+        "group": group[starts],
+        "count": counts,
+        "min": total[starts],
+        "median": _quantile(total, starts, counts, 0.5),
+        "p95": _quantile(total, starts, counts, 0.95),
+        "max": total[starts + counts - 1],
+    }
+    sums = np.add.reduceat(durations, starts, axis=0)
+    for i, kind in enumerate(KINDS):
+        stats[kind] = sums[:, i] / counts
+    return stats
+
+
+def _top(
+    stats: Dict[str, np.ndarray], labels: np.ndarray, key: str, top: int, sort: str
+) -> List[Dict[str, Any]]:
+    order = np.argsort(-stats[sort], kind="stable")[:top]
+    return [
+        {
+            key: labels[stats["group"][i]],
+            "count": int(stats["count"][i]),
+            **{name: float(stats[name][i]) for name in STATS + KINDS},
+        }
+        for i in order
+    ]
+
+
+def summarize(
+    frame: Frame, top: int = 50, sort: str = "p95", test_file: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Top ``top`` nodeids and test files, sorted by descending ``sort``.
+
+    If ``test_file`` is given, only nodeids of this file are considered.
+    """
+    if sort not in STATS + KINDS:
+        raise ValueError(f"Can't sort by {sort!r}")
+    test_files = frame.test_files()
+    unique_files, file_of_node = np.unique(test_files, return_inverse=True)
+
+    # sum the rows of each (test file, matrix file) before computing statistics
+    # across matrix files.
+    key = file_of_node[frame.node] * len(frame.files) + frame.file
+    keys, inverse = np.unique(key, return_inverse=True)
+    per_file = np.stack(
+        [
+            np.bincount(inverse, weights=frame.durations[:, i], minlength=len(keys))
+            for i in range(3)
+        ],
+        axis=1,
+    )
+    file_stats = group_stats(keys // len(frame.files), per_file)
+
+    rows = np.ones(len(frame.node), dtype=bool)
+    if test_file is not None:
+        rows = test_files[frame.node] == test_file
+    node_stats = group_stats(frame.node[rows], frame.durations[rows])
+
+    return {
+        "n_files": len(frame.files),
+        "n_rows": len(frame.node),
+        "n_nodeids": len(frame.nodeids),
+        "nodeids": _top(node_stats, frame.nodeids, "nodeid", top, sort),
+        "files": _top(file_stats, unique_files, "file", top, sort),
+    }
+
+
+def rows_for(frame: Frame, nodeid: str) -> List[Dict[str, Any]]:
+    """
+    Raw rows of one nodeid, one per matrix file, for drill down.
+    """
+    if nodeid not in frame.index:
+        return []
+    i = frame.index[nodeid]
+    return [
+        {
+            "file": frame.files[f],
+            **{kind: float(d) for kind, d in zip(KINDS, durations)},
+        }
+        for f, durations in zip(
+            frame.file[frame.node == i], frame.durations[frame.node == i]
+        )
+    ]
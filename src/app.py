@@ -1,38 +1,83 @@
-import gc
+import gzip
+import hmac
 import json
 import logging
+import math
 import os
-import shelve
-import time
-from base64 import b64decode
+import tempfile
+import zlib
+from collections import OrderedDict
 from dataclasses import dataclass
+from hashlib import sha256
 from datetime import datetime, timedelta
-from hashlib import sha512
-from io import BytesIO
 from os import environ, environb
 from pathlib import Path
 from random import choice, randint
-from typing import List, NewType
-from zipfile import ZipFile
+from typing import Any, Callable, Dict, List, NewType, Optional, Tuple
+from urllib.parse import urlencode
 
-import httpx
-import jwt
-import requests
-import requests_cache
+import trio
 from dateutil.parser import isoparse
-from dotenv import load_dotenv
-from psycopg2.errors import UniqueViolation
-from quart import Response, make_response, render_template, send_file
+from psycopg2.extras import execute_values
+from quart import Response, make_response, render_template, request, send_file
 from quart_trio import QuartTrio
 
-from .auth import Auth
-from .github_types import CommitSha, PullRequest, RunId, WorkflowRun
-from .postgres import db_get_cursor
-
-load_dotenv()
-
-session = requests_cache.CachedSession("../erase_cache")
-
+from .aggregate import KINDS, STATS, Frame, rows_for, summarize
+from .artifacts import ARTIFACTS
+from .auth import (
+    ACTIONS_AUDIENCE,
+    ACTIONS_ISSUER,
+    AUTH_TOKEN_FILE,
+    ActionsTokens,
+    Auth,
+)
+from .client import CLIENT, GITHUB_API_URL, URGENT
+from .github_types import (
+    Artifact,
+    ArtifactWorkflowRun,
+    CommitSha,
+    Head,
+    PullRequest,
+    RunId,
+    WorkflowRun,
+)
+from .jobs import INGEST_WORKERS, QUEUE, Job
+from .metrics import (
+    DOWNLOADED_BYTES,
+    METRICS_DIR,
+    PUBLISH_INTERVAL,
+    SSE_STREAMS,
+    Counter,
+    Gauge,
+    merged,
+    publish,
+    render,
+    snapshot,
+    stage,
+    start_trace,
+)
+from .parsing import PARSER, compact_archive_member, list_members
+from .postgres import LOCKS, db_run
+from .regressions import Baseline, compare
+from .remote_zip import download_reports
+from .reports import CompItem
+from .singleflight import SingleFlight
+from .store import (
+    ACTION_RUN_ORDER,
+    PULL_ORDER,
+    get_baseline,
+    get_baseline_state,
+    get_head_summary,
+    get_report_tables,
+    get_uploads,
+    ingest_test_results,
+    list_page,
+    put_baseline,
+    put_head_summary,
+    put_report_tables,
+    put_upload,
+)
+from .wire import encode_compact
 
 
 @dataclass
@@ -54,102 +99,123 @@ class ServerSentEvent:
         return message.encode("utf-8")
 
 
-app = QuartTrio(__name__)
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s",
-    level=logging.INFO,
-)
-log = logging.getLogger(__name__)
-
-APP_ID = environ.get("APP_ID")
-pem_b = environb.get(b"PEM64")
-pem_data = b64decode(pem_b)  # type:ignore
-log.info("APP_ID %s PEM DIGEST %s", APP_ID, sha512(pem_data).hexdigest())
-
-
-instance = jwt.JWT()
-pem_file = jwt.jwk_from_pem(pem_data)
-
+def _tables_json(tables: Dict[str, str]) -> str:
+    """
+    ``tables`` maps each report file name to its already serialised ``comp``
+    list, build the ``{name: {"comp": [...]}}`` JSON without parsing them again.
+    """
+    body = ", ".join(
+        f'{json.dumps(member)}: {{"comp": {comp}}}' for member, comp in tables.items()
+    )
+    return f"{{{body}}}"
 
-MINUTE = 60
-VALIDITY = 1 * MINUTE
 
+def test_data_event(tables: Dict[str, str]) -> bytes:
+    """
+    Final event with all the ``comp`` tables.
+    """
+    return ServerSentEvent(
+        f'{{"test_data": {_tables_json(tables)}, "info": "done"}}'
+    ).encode()
 
-def bt():
-    payload = {
-        "iat": int(time.time()),
-        "exp": int(time.time()) + VALIDITY,
-        "iss": APP_ID,
-    }
-    return instance.encode(payload, pem_file, alg="RS256")
 
+def compact_event(artifact_ids: List[int]) -> bytes:
+    """
+    In compact format, tell the client where to fetch the tables of these
+    artifacts.
+    """
+    ids = ",".join(map(str, artifact_ids))
+    return ServerSentEvent(json.dumps({"compact": f"/api/compact/{ids}"})).encode()
 
-PAT = bt()
-headers = {"Authorization": f"Bearer {PAT}", "Accept": "application/vnd.github.v3+json"}
 
-inst = session.get("https://api.github.com/app/installations", headers=headers).json()
+def file_data_events(tables: Dict[str, str]):
+    """
+    In streaming mode, one event per report file, sent as soon as it is ready.
+    """
+    for member, comp in tables.items():
+        yield ServerSentEvent(
+            f'{{"file_data": {_tables_json({member: comp})}}}'
+        ).encode()
 
 
-installation_id = inst[0]["id"]
-access_token_url = (
-    f"https://api.github.com/app/installations/{installation_id}/access_tokens"
+app = QuartTrio(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s",
+    level=logging.INFO,
 )
+log = logging.getLogger(__name__)
 
+# GitHub is only called once the app serves, see auth.py.
+AUTH = Auth(environ.get("APP_ID"), environb.get(b"PEM64"), Path(AUTH_TOKEN_FILE))
+ACTIONS_TOKENS = ActionsTokens(ACTIONS_ISSUER, ACTIONS_AUDIENCE)
 
-AUTH = Auth(access_token_url, bt)
 
+# maximum number of concurrent requests to GitHub when listing or downloading
+# the artifacts of one PR.
+FETCH_CONCURRENCY = int(environ.get("FETCH_CONCURRENCY", 8))
 
-response = requests.post(access_token_url, data=b"", headers=headers)
 
-idata = response.json()
+# rows per page of the listings, by default and at most.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
 
-h2 = {
-    "Authorization": f"token {idata['token']}",
-    "Accept": "application/vnd.github.v3+json",
-}
+async def paginated(table: str, order: List[str], item: Callable[[Dict], Any]):
+    """
+    A page of the listing of ``table``, most recent first, filtered by the
+    ``org`` and ``repo`` query parameters, with ``item(row)`` for each row.
+
+    Like GitHub, the url of the next page is in the ``Link`` header, so that
+    the body stays a plain list; its ``after`` parameter is an opaque cursor.
+    """
+    filters = {}
+    if "org" in request.args:
+        filters["organization"] = request.args["org"]
+    if "repo" in request.args:
+        if not filters:
+            return Response(json.dumps({"error": "repo needs org"}), status=400)
+        filters["repo"] = request.args["repo"]
+    try:
+        per_page = int(request.args.get("per_page", PAGE_SIZE))
+    except ValueError:
+        return Response(json.dumps({"error": "invalid per_page"}), status=400)
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    try:
+        page = await list_page(
+            table, order, filters, request.args.get("after"), per_page
+        )
+    except (ValueError, TypeError):
+        return Response(json.dumps({"error": "invalid cursor"}), status=400)
+    if page is None:
+        raise RuntimeError(f"Could not list {table}")
+    rows, after = page
+    headers = {"Content-Type": "application/json"}
+    if after is not None:
+        query = urlencode({**request.args.to_dict(), "after": after})
+        headers["Link"] = f'<{request.path}?{query}>; rel="next"'
+    return json.dumps([item(row) for row in rows]), 200, headers
 
 
 @app.route("/api/pulls")
 async def pulls():
-    with db_get_cursor() as cursor:
-        try:
-            cursor.execute(
-                #  here we want only T UNIQUE organization, repo, pull_number  FROM action_run LIMIT 50 ORDER BY id DESC
-                """
-                SELECT DISTINCT ON (organization, repo, pull_number)
-                    organization, repo, pull_number
-                FROM action_run
-                ORDER BY organization, repo, pull_number DESC
-                LIMIT 50
-            """
-            )
-            results = cursor.fetchall()
-            data = [
-                {
-                    "value": f"/gh/{org}/{repo}/pull/{pull_number}",
-                    "name": f"{org}/{repo}/{pull_number}",
-                }
-                for org, repo, pull_number in results
-            ]
-            return json.dumps(data)
-        except Exception as e:
-            log.exception(e)
-            raise
+    def item(row):
+        org, repo, pull_number = row["organization"], row["repo"], row["pull_number"]
+        return {
+            "value": f"/gh/{org}/{repo}/pull/{pull_number}",
+            "name": f"{org}/{repo}/{pull_number}",
+        }
 
-    # dat_ = {
-    #    "{}/{}".format(choice(["ipython/ipython", "napari/napari"]), randint(1, 100))
-    #    for _ in range(10)
-    # }
-    # data = [{"value": x, "name": x} for x in dat_]
-    # return json.dumps(data)
+    return await paginated("pull_request", PULL_ORDER, item)
 
 
 @app.route("/gh/<org>/<repo>")
 async def other(org, repo):
-    all_data = session.get(
-        f"https://api.github.com/repos/{org}/{repo}/pulls", headers=AUTH.header
-    ).json()
+    resp = await CLIENT.get(
+        f"{GITHUB_API_URL}/repos/{org}/{repo}/pulls",
+        headers=await AUTH.header(org, repo),
+        urgent=False,
+    )
+    all_data = resp.json()
     return json.dumps([x["number"] for x in all_data])
 
 
@@ -158,38 +224,164 @@ async def index():
     return await render_template("index.html", org=None, repo=None, number=None)
 
 
+async def record_action_runs(
+    org: str,
+    repo: str,
+    pull_number: int,
+    run_ids: List[RunId],
+    head_sha: Optional[CommitSha] = None,
+) -> None:
+    """
+    Insert all the action runs of a pull request, for the head ``head_sha`` if
+    known, in a single round trip.
+    """
+
+    def insert(cursor):
+        rows = execute_values(
+            cursor,
+            """
+            INSERT INTO action_run (organization, repo, run_id, pull_number, head_sha)
+            VALUES %s
+            ON CONFLICT (organization, repo, run_id, pull_number) DO UPDATE
+            SET head_sha = COALESCE(action_run.head_sha, EXCLUDED.head_sha)
+            RETURNING xmax = 0
+            """,
+            [(org, repo, run_id, pull_number, head_sha) for run_id in run_ids],
+            fetch=True,
+        )
+        if any(inserted for inserted, in rows):
+            # a new run, the pull goes to the top of /api/pulls.
+            cursor.execute(
+                """
+                INSERT INTO pull_request (organization, repo, pull_number)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (organization, repo, pull_number) DO UPDATE
+                SET last_seen_at = now()
+                """,
+                (org, repo, pull_number),
+            )
+
+    if run_ids:
+        await db_run(insert)
+
+
 @app.route("/collect_artifact_metadata/<org>/<repo>/<int:pull_number>/<run_id>")
 async def collect_artifact_metadata(org: str, repo: str, pull_number: int, run_id: str):
     assert isinstance(org, str)
     assert isinstance(repo, str)
     assert isinstance(pull_number, int)
     assert isinstance(run_id, str)
-    with db_get_cursor() as cursor:
-        try:
-            # Should we have a ON CONFLICT (organization, repo, run_id, pull_number) DO NOTHING;
-            res = cursor.execute(
-                """
-                INSERT INTO action_run (organization, repo, run_id, pull_number)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (organization, repo, run_id, pull_number) DO NOTHING
-            """,
-                (org, repo, run_id, pull_number),
-            )
-            return "ok"
-        except UniqueViolation:
-            return "duplicate"
+    await record_action_runs(org, repo, pull_number, [RunId(int(run_id))])
+    return "ok"
 
 
 @app.route("/action_run")
 async def list_action_runs():
-    with db_get_cursor() as cursor:
-        cursor.execute(
-            """
-            SELECT organization, repo, pull_number, run_id FROM action_run
-        """,
-            (),
-        )
-        return cursor.fetchall()
+    def item(row):
+        return [row["organization"], row["repo"], row["pull_number"], row["run_id"]]
+
+    return await paginated("action_run", ACTION_RUN_ORDER, item)
+
+
+@app.route("/api/artifact_stats")
+async def artifact_stats():
+    """
+    Size and hit / miss / eviction counters of the on-disk artifact store, and
+    usage of the parse pool.
+    """
+    return json.dumps(dict(ARTIFACTS.stats(), parse_pool=PARSER.stats()))
+
+
+@app.route("/api/http_stats")
+async def http_stats():
+    return json.dumps(CLIENT.stats())
+
+
+# read from the components when rendered, see metrics.py.
+Counter(
+    "ptv_github_requests_total",
+    "Requests made by the HTTP client.",
+    ["host"],
+    lambda: {(host,): n for host, n in CLIENT.requests.items()},
+)
+Counter(
+    "ptv_github_errors_total",
+    "Requests of the HTTP client that failed.",
+    ["host"],
+    lambda: {(host,): n for host, n in CLIENT.errors.items()},
+)
+Counter(
+    "ptv_http_cache_total",
+    "Lookups in the ETag cache of the HTTP client, by result.",
+    ["result"],
+    lambda: {(result,): n for result, n in CLIENT.cache.items()},
+)
+Gauge(
+    "ptv_github_rate_remaining",
+    "Remaining GitHub rate limit, by installation (or app).",
+    ["installation"],
+    lambda: {
+        (key,): budget.remaining
+        for key, budget in CLIENT._budgets.items()
+        if budget.remaining is not None
+    },
+    # installations are shared by the processes, the lowest count is the latest.
+    aggregate=min,
+)
+Counter(
+    "ptv_artifact_store_total",
+    "Hits, misses, writes and evictions of the artifact store.",
+    ["event"],
+    lambda: {(event,): n for event, n in ARTIFACTS.counters.items()},
+)
+Gauge(
+    "ptv_artifact_store_bytes",
+    "Size of the archives in the artifact store.",
+    callback=lambda: {(): ARTIFACTS.stats()["size"]},
+    # the processes share the store.
+    aggregate=max,
+)
+Gauge(
+    "ptv_parse_pool_tasks",
+    "Tasks of the parse pool, running or waiting for a worker.",
+    ["state"],
+    lambda: {(state,): PARSER.stats()[state] for state in ("busy", "waiting")},
+)
+Gauge(
+    "ptv_ingestions_in_progress",
+    "Ingestions and baseline refreshes running in the background.",
+    callback=lambda: {(): len(FLIGHTS)},
+)
+
+
+@app.route("/metrics")
+async def metrics():
+    snapshots = snapshot()
+    if METRICS_DIR is not None:
+        snapshots = await trio.to_thread.run_sync(merged, snapshots)
+    return render(snapshots), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@app.before_serving
+async def start_metrics():
+    async def publish_forever():
+        while True:
+            await trio.to_thread.run_sync(publish, snapshot())
+            await trio.sleep(PUBLISH_INTERVAL)
+
+    if METRICS_DIR is not None:
+        app.nursery.start_soon(publish_forever)
+
+
+@app.before_serving
+async def start_auth():
+    AUTH.start(app.nursery)
+
+
+@app.after_serving
+async def close_client():
+    await CLIENT.aclose()
+    PARSER.shutdown()
 
 
 @app.route("/gh/<org>/<repo>/pull/<number>")
@@ -209,6 +401,15 @@ async def index_js():
     return await send_file(os.path.join(path, "templates", "index.js"))
 
 
+@app.route("/upload.py")
+async def upload_py():
+    """
+    The uploader, for the CI of other repositories, see upload.py.
+    """
+    path = os.path.dirname(os.path.realpath(__file__))
+    return await send_file(os.path.join(path, "upload.py"), mimetype="text/x-python")
+
+
 def clean_item(d):
     del d["created"]
     del d["duration"]
@@ -224,6 +425,83 @@ def clean_item(d):
         del t["outcome"]
 
 
+async def get_known_run_ids(
+    org: str, repo: str, pull_number: int, head_sha: CommitSha
+) -> List[RunId]:
+    """
+    Run ids recorded for this head of the pull request, seen on a previous view
+    or by a webhook, most recent first.
+    """
+
+    def select(cursor):
+        cursor.execute(
+            """
+            SELECT run_id FROM action_run
+            WHERE organization = %s AND repo = %s AND pull_number = %s
+                AND head_sha = %s
+            ORDER BY run_id DESC
+            """,
+            (org, repo, pull_number, head_sha),
+        )
+        return [RunId(run_id) for run_id, in cursor.fetchall()]
+
+    return await db_run(select) or []
+
+
+async def get_workflow_runs(
+    org: str, repo: str, run_ids: List[RunId]
+) -> List[WorkflowRun]:
+    """
+    Fetch workflow runs directly by id, skipping the ones that no longer exist.
+    """
+    runs: Dict[RunId, WorkflowRun] = {}
+    limiter = trio.CapacityLimiter(FETCH_CONCURRENCY)
+
+    async def get_run(run_id: RunId):
+        async with limiter:
+            resp = await CLIENT.get(
+                f"{GITHUB_API_URL}/repos/{org}/{repo}/actions/runs/{run_id}",
+                headers=await AUTH.header(org, repo),
+            )
+        if resp.status_code == 404:
+            log.warning("Workflow run %s not found on %s/%s", run_id, org, repo)
+            return
+        resp.raise_for_status()
+        runs[run_id] = WorkflowRun.from_json(resp.json())
+
+    async with trio.open_nursery() as nursery:
+        for run_id in run_ids:
+            nursery.start_soon(get_run, run_id)
+    return [runs[run_id] for run_id in run_ids if run_id in runs]
+
+
+async def discover_workflow_runs(
+    org: str, repo: str, number: str, head: Head
+) -> Tuple[List[WorkflowRun], bool]:
+    """
+    Return the workflow runs for the head of a pull request, and whether they
+    are all of them.
+
+    While some of the runs we already know for this head are in progress, they
+    are fetched directly by id, and their artifacts can then be listed with
+    ``/repos/{owner}/{repo}/actions/runs/{run_id}/artifacts``. Runs we don't
+    know of may be missing, so otherwise, as the head summary is about to be
+    frozen, we crawl the runs of the repository.
+    """
+    run_ids = await get_known_run_ids(org, repo, int(number), head.sha)
+    if run_ids:
+        wrs = await get_workflow_runs(org, repo, run_ids)
+        if not all(w.status == "completed" for w in wrs):
+            log.info("Found %s known runs for %s, skipping crawl", len(wrs), head.sha)
+            return wrs, False
+    return await collect_most_recent_workflow_runs(org, repo, head.ref, head.sha), True
+
+
+# upper bound on the number of pages of runs we are willing to crawl.
+MAX_RUN_PAGES = 50
+RUNS_PER_PAGE = 100
+
+
 async def collect_most_recent_workflow_runs(
     org: str, repo: str, ref: str, sha: CommitSha
 ) -> List[WorkflowRun]:
@@ -232,100 +510,528 @@ async def collect_most_recent_workflow_runs(
 
     This is a workaround from GitHub not allowing us to get all runs for a given
     PR.
-    """
-    w_runs: List[WorkflowRun] = []
-    async with httpx.AsyncClient() as client:
-        log.warning(
-            "Looking for runs artifacts on for %s/%s, ref=%s sha=%s",
-            org,
-            repo,
-            ref,
-            sha,
-        )
-        for i in range(50):
-            log.warning("Looking for runs artifacts on page %s", i)
-
-            d = (
-                await client.get(
-                    f"https://api.github.com/repos/{org}/{repo}/actions/runs",
-                    params={
-                        "per_pages": 100,
-                        "page": i,
-                        "event": "pull_request",
-                        # "branch": ref,
-                        "head_sha": sha,
-                        # it might be interested to also ast for hte head_sha
-                        # parameter if we knkow the pr numbe
-                    },
-                    headers=AUTH.header,
-                )
-            ).json()
-            wrs = [WorkflowRun.from_json(x) for x in d["workflow_runs"]]
-            w_runs.extend(wrs)
-            if len(d["workflow_runs"]) == 0:
-                # we do get a `total_count` so we might be able to do better
-                log.info("No more run after page %s", i)
-                break
-    return w_runs
 
-
-async def list_artifacts_urls_to_download(
-    data: List[WorkflowRun], head_sha: CommitSha, number: int
-) -> List[str]:
+    The first page tells us the ``total_count`` of runs for this sha, the
+    remaining pages are then fetched in parallel.
+    """
+    log.warning(
+        "Looking for runs artifacts on for %s/%s, ref=%s sha=%s",
+        org,
+        repo,
+        ref,
+        sha,
+    )
+    pages: Dict[int, List[WorkflowRun]] = {}
+    limiter = trio.CapacityLimiter(FETCH_CONCURRENCY)
+
+    async def get_page(page: int) -> int:
+        log.warning("Looking for runs artifacts on page %s", page)
+        async with limiter, stage("runs_page"):
+            resp = await CLIENT.get(
+                f"{GITHUB_API_URL}/repos/{org}/{repo}/actions/runs",
+                params={
+                    "per_page": RUNS_PER_PAGE,
+                    "page": page,
+                    "event": "pull_request",
+                    # "branch": ref,
+                    "head_sha": sha,
+                },
+                headers=await AUTH.header(org, repo),
+            )
+        d = resp.json()
+        pages[page] = WorkflowRun.from_json_list(d["workflow_runs"])
+        return d["total_count"]
+
+    # GitHub pages start at 1.
+    total_count = await get_page(1)
+    n_pages = min(MAX_RUN_PAGES, math.ceil(total_count / RUNS_PER_PAGE))
+    log.info("%s runs for sha %s, %s pages", total_count, sha, n_pages)
+    async with trio.open_nursery() as nursery:
+        for page in range(2, n_pages + 1):
+            nursery.start_soon(get_page, page)
+
+    return [w for page in sorted(pages) for w in pages[page]]
+
+
+async def list_artifacts_to_download(
+    org: str,
+    repo: str,
+    data: List[WorkflowRun],
+    head_sha: Optional[CommitSha],
+    label: str,
+) -> List[Artifact]:
     """
     Filter worflow runs that both:
-        - have the same head_sha as the one we want
+        - have the same head_sha as the one we want (if not None)
         - have pytest in the name of the artifact
+
+    ``label`` says what the runs are for in the logs, a PR number or a branch.
     """
-    acc = []
-    async with httpx.AsyncClient(follow_redirects=True) as client:
+    found: Dict[int, List[Artifact]] = {}
+    limiter = trio.CapacityLimiter(FETCH_CONCURRENCY)
+
+    async def list_run(i: int, d: WorkflowRun):
+        async with limiter, stage("list_run_artifacts"):
+            resp = await CLIENT.get(
+                d.artifacts_url,
+                headers=await AUTH.header(org, repo),
+            )
+        data2 = resp.json()
+        log.info("x-ratelimit-remaining: %s", resp.headers.get("X-RateLimit-Remaining"))
+        log.debug(
+            "Found Artifacts %s on page %s (%s)",
+            str(len(data2["artifacts"])),
+            str(i),
+            label,
+        )
+
+        found[i] = []
+        for artifact in data2["artifacts"]:
+            log.info("Artifact: %s", artifact["name"])
+            if "pytest" in artifact["name"]:
+                log.warning(
+                    "Found pytest in name for %s in workflow %s, workflod id: %s",
+                    artifact["name"],
+                    d.artifacts_url,
+                    d.id,
+                )
+                found[i].append(Artifact.from_json(artifact))
+
+    async with trio.open_nursery() as nursery:
         for i, d in enumerate(data):
             log.debug("analysing workflow run %s", d.id)
             log.debug("    head_sha %s", d.head_sha)
             log.debug("    id: %s", d.id)
             log.debug("    artifact_url %s", d.artifacts_url)
             log.debug("    artifact contains id: %s", str(d.id) in d.artifacts_url)
-            if d.head_sha != head_sha:
+            if head_sha is not None and d.head_sha != head_sha:
                 log.warning("Skipping workflow %s, head sha does not match", d.id)
                 continue
-            resp = await client.get(
-                d.artifacts_url,
-                headers=AUTH.header,
-            )
-            data2 = resp.json()
-            log.info("x-ratelimit-remaining: %s", resp.headers["X-RateLimit-Remaining"])
-            log.debug(
-                "Found Artifacts %s on page %s (pr %s)",
-                str(len(data2["artifacts"])),
-                str(i),
-                str(number),
+            nursery.start_soon(list_run, i, d)
+
+    # keep the order of the workflow runs, whatever order the requests finished in
+    acc = [a for i in sorted(found) for a in found[i]]
+    log.info("Found %s artifacts for %s with pytest in name", len(acc), label)
+
+    return list({a.id: a for a in acc}.values())
+
+
+async def list_reports(
+    org: str,
+    repo: str,
+    data: List[WorkflowRun],
+    head_sha: Optional[CommitSha],
+    label: str,
+) -> List[Artifact]:
+    """
+    Like list_artifacts_to_download, but runs that uploaded their reports (see
+    api_upload) are not looked up on GitHub, their uploads are used instead.
+    """
+    runs = [d for d in data if head_sha is None or d.head_sha == head_sha]
+    uploads = await get_uploads(org, repo, [d.id for d in runs])
+    uploaded = {a.workflow_run.id for a in uploads}
+    if uploaded:
+        log.info("Using uploaded reports of runs %s", sorted(uploaded))
+    acc = await list_artifacts_to_download(
+        org, repo, [d for d in runs if d.id not in uploaded], head_sha, label
+    )
+    return uploads + acc
+
+
+async def fetch_report_tables(
+    org: str, repo: str, acc: List[Artifact], number: str, send
+) -> None:
+    """
+    Get the compacted tables of all the artifacts, downloading and parsing at
+    most FETCH_CONCURRENCY of them at the same time.
+
+    Progress is published with ``send("info", message)``, and once the tables
+    of an artifact are stored, ``send("tables", index, n_files)``, in whatever
+    order they finish. The tables themselves are not published: flights keep
+    their messages for late subscribers, they read them from the cache.
+    """
+    limiter = trio.CapacityLimiter(FETCH_CONCURRENCY)
+    la = len(acc)
+
+    async def fetch_one(i: int, artifact: Artifact):
+        archive = artifact.archive_download_url
+        with stage("report_cache"):
+            tables = await get_report_tables([artifact.id])
+        if tables is not None:
+            log.debug("PARSED CACHE HIT %s", artifact.id)
+            send("tables", i, len(tables))
+            return
+        if artifact.id < 0:
+            # uploads are stored with their tables, there is nothing to download.
+            log.warning("Tables of upload %s could not be read", -artifact.id)
+            return
+        log.warning(f"Requesting Content... %s ({number})", i)
+        log.debug("archive %s", archive)
+        path = await trio.to_thread.run_sync(ARTIFACTS.pin, artifact.id)
+        if path is None:
+            log.debug("Sending SSE")
+            send("info", f"Downloading artifacts {i+1}/{la}...")
+            log.info("Downloading artifact...")
+            writer = await trio.to_thread.run_sync(ARTIFACTS.writer, artifact.id)
+            try:
+                async with limiter:
+                    with stage("download", artifact=str(artifact.id)):
+                        await download_reports(
+                            archive,
+                            writer.write,
+                            writer.reset,
+                            artifact.size_in_bytes,
+                            await AUTH.header(org, repo),
+                        )
+                DOWNLOADED_BYTES.inc(writer.size)
+                path = await trio.to_thread.run_sync(writer.commit)
+            except BaseException:
+                await trio.to_thread.run_sync(writer.abort)
+                raise
+            log.debug("Downloaded...")
+            send("info", f"Got artifacts {i+1}/{la}...")
+        try:
+            send("info", f"Extracting artifact {i+1}...")
+            members = await trio.to_thread.run_sync(list_members, path)
+            lll = len(members)
+            results: List[List[CompItem]] = [[] for _ in members]
+
+            async def compact(j: int, member: str):
+                log.warning(f"rezip... %s/%s %s ({number})", j, lll, member)
+                ## keep only what's necessary, in a worker process
+                with stage("parse", member=member):
+                    results[j] = await PARSER.run(compact_archive_member, path, member)
+                send("info", f"Processed file {i+1}-{j+1}/{lll}...")
+
+            async with trio.open_nursery() as nursery:
+                for j, member in enumerate(members):
+                    nursery.start_soon(compact, j, member)
+        finally:
+            ARTIFACTS.unpin(artifact.id)
+        comps = dict(zip(members, results))
+        with stage("store", artifact=str(artifact.id)):
+            tables = {member: json.dumps(comp) for member, comp in comps.items()}
+            await put_report_tables(artifact.id, tables)
+            await ingest_test_results(org, repo, artifact, comps)
+        send("tables", i, len(tables))
+
+    async with trio.open_nursery() as nursery:
+        for i, artifact in enumerate(acc):
+            nursery.start_soon(fetch_one, i, artifact)
+
+
+async def send_head_summary(org: str, repo: str, sha: CommitSha, send) -> bool:
+    """
+    Publish the tables of the head summary of ``sha``, like ingest_head does,
+    if there is one.
+    """
+    artifact_ids = await get_head_summary(org, repo, sha)
+    if artifact_ids is None:
+        return False
+    tables = [await get_report_tables([artifact_id]) for artifact_id in artifact_ids]
+    if any(t is None for t in tables):
+        return False
+    log.info("%s was ingested by another process meanwhile", sha)
+    send("artifacts", artifact_ids)
+    for i, artifact_tables in enumerate(tables):
+        send("tables", i, len(artifact_tables))
+    return True
+
+
+async def ingest_head(org: str, repo: str, number: str, head: Head, send) -> None:
+    """
+    Discover, download and parse all the artifacts for the head of a PR.
+
+    Runs in the background, once per head however many viewers there are (see
+    FLIGHTS). Messages are published with ``send``: ``("info", message)`` for
+    progress, ``("artifacts", artifact_ids)`` once they are known, then
+    ``("tables", index, n_files)`` for each of them, or ``("error", message)``.
+    """
+    # another process may be ingesting this head, what it parsed by the time we
+    # get the lock is in the cache.
+    async with LOCKS.hold(
+        f"ingest {org}/{repo} {head.sha}",
+        lambda: send("info", "Waiting for another worker on this PR..."),
+    ) as waited:
+        if waited and await send_head_summary(org, repo, head.sha, send):
+            return
+        try:
+            with stage("discover_runs"):
+                wrs, complete = await discover_workflow_runs(org, repo, number, head)
+
+            log.warning("Looking for Artifacts...")
+            send("info", "Looking for GH artifacts...")
+            log.debug("Workflow runs id: %r", [(w.id, w.head_sha) for w in wrs])
+
+            await record_action_runs(
+                org, repo, int(number), [RunId(w.id) for w in wrs], head.sha
             )
+            with stage("list_artifacts"):
+                acc = await list_reports(org, repo, wrs, head.sha, label=f"PR {number}")
+            log.debug("artefacts to download: %s", acc)
+            send("artifacts", [a.id for a in acc])
+            send("info", "Requesting list of artifact from GH...")
+
+            with stage("fetch_artifacts"):
+                await fetch_report_tables(org, repo, acc, number, send)
+        except Exception as e:
+            # we run in the app nursery, don't let that take the server down.
+            log.exception("Failed to fetch artifacts for PR %s", number)
+            send("error", f"Failed to fetch artifacts: {e}")
+            return
+
+        head_runs = [w for w in wrs if w.head_sha == head.sha]
+        if complete and head_runs and all(w.status == "completed" for w in head_runs):
+            await put_head_summary(org, repo, head.sha, [a.id for a in acc])
 
-            for artifact in data2["artifacts"]:
-                log.info("Artifact: %s", artifact["name"])
-                if "pytest" in artifact["name"]:
-                    log.warning(
-                        "Found pytest in name for %s in workflow %s, workflod id: %s",
-                        artifact["name"],
-                        d.artifacts_url,
-                        d.id,
-                    )
-                    acc.append(artifact["archive_download_url"])
 
-        log.info("Found %s artifacts for PR %s with pytest in name", len(acc), number)
+# largest upload we accept, uncompressed, in bytes.
+UPLOAD_MAX_BYTES = int(environ.get("UPLOAD_MAX_BYTES", 256 * 1024**2))
 
-    return list(set(acc))
 
+def parse_upload(body: bytes) -> Dict[str, List[CompItem]]:
+    """
+    ``{member: comp}`` from the JSON of an upload, raises ValueError or
+    TypeError if it does not have that shape.
+    """
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("expected an object")
+    return {
+        str(member): [
+            (str(nodeid), float(call), float(setup), float(teardown))
+            for nodeid, call, setup, teardown in comp
+        ]
+        for member, comp in data.items()
+    }
+
+
+@app.route("/api/upload/<org>/<repo>/<int:run_id>", methods=["POST"])
+async def api_upload(org: str, repo: str, run_id: int):
+    """
+    Reports of a run, already compacted by upload.py in the CI job, as gzipped
+    JSON ``{member: comp}``. They are then used instead of the
+    artifacts of the run, see list_reports.
+
+    The ``Authorization`` header must hold an OIDC token of the job that
+    uploads, for ACTIONS_AUDIENCE: its claims tie it to this very run, which
+    a GITHUB_TOKEN doesn't, any job of the repository, or of a fork, could use
+    one to upload reports of other runs. The head of the run comes from
+    GitHub, not from the uploader, and its attempt from the token, as re-runs
+    upload under the same names.
+    """
+
+    def error(status: int, message: str) -> Response:
+        return Response(json.dumps({"error": message}), status=status)
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        return error(401, "missing token")
+    try:
+        claims = await ACTIONS_TOKENS.verify(token)
+    except ValueError as e:
+        return error(401, f"invalid token: {e}")
+    if (
+        claims.get("repository", "").lower() != f"{org}/{repo}".lower()
+        or claims.get("run_id") != str(run_id)
+    ):
+        return error(403, f"not a token of run {run_id} of {org}/{repo}")
+    attempt = str(claims.get("run_attempt", 1))
+    if not attempt.isnumeric():
+        return error(403, f"invalid run attempt {attempt!r}")
+    resp = await CLIENT.get(
+        f"{GITHUB_API_URL}/repos/{org}/{repo}/actions/runs/{run_id}",
+        headers=await AUTH.header(org, repo),
+    )
+    if resp.status_code != 200:
+        return error(404, f"run {run_id} of {org}/{repo} not found")
+    run = ArtifactWorkflowRun.from_json(resp.json())
+
+    # decompress as it arrives, to refuse overly large uploads early.
+    decompress = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    body = bytearray()
+    try:
+        async for chunk in request.body:
+            body += decompress.decompress(chunk, UPLOAD_MAX_BYTES + 1 - len(body))
+            if len(body) > UPLOAD_MAX_BYTES or decompress.unconsumed_tail:
+                return error(413, f"more than {UPLOAD_MAX_BYTES} bytes")
+        body += decompress.flush()
+        comps = await trio.to_thread.run_sync(parse_upload, bytes(body))
+    except (zlib.error, ValueError, TypeError) as e:
+        return error(400, f"invalid upload: {e}")
+    if not comps:
+        return error(400, "no reports in the upload")
+
+    name = request.args.get("name") or ",".join(sorted(comps))
+    tables = {member: json.dumps(comp) for member, comp in comps.items()}
+    with stage("store", upload=name):
+        artifact = await put_upload(org, repo, run, int(attempt), name, tables)
+        if artifact is None:
+            raise RuntimeError(f"Could not record upload for run {run_id}")
+        await ingest_test_results(org, repo, artifact, comps)
+    pull_number = request.args.get("pull", "")
+    if pull_number.isnumeric():
+        await record_action_runs(
+            org, repo, int(pull_number), [RunId(run_id)], run.head_sha
+        )
+    log.info("Upload %s for run %s of %s/%s: %s", name, run_id, org, repo, len(comps))
+    return json.dumps(
+        {
+            "artifact_id": artifact.id,
+            "files": len(comps),
+            "tests": sum(len(comp) for comp in comps.values()),
+        }
+    )
+
+
+# number of recent runs of the base branch a baseline is computed from, and
+# how old (in seconds) it can get before being refreshed in the background.
+BASELINE_RUNS = int(environ.get("BASELINE_RUNS", 10))
+BASELINE_MAX_AGE = float(environ.get("BASELINE_MAX_AGE", 3600))
+# pages of push runs we look through for runs with reports.
+BASELINE_MAX_PAGES = int(environ.get("BASELINE_MAX_PAGES", 5))
+
+
+async def baseline_reports(
+    org: str, repo: str, branch: str
+) -> Tuple[List[RunId], List[Artifact]]:
+    """
+    The most recent BASELINE_RUNS completed push runs of ``branch`` that have
+    pytest reports, and these reports.
+
+    Lint, docs or release workflows run on pushes too, so we page through the
+    runs until enough of them have reports, or BASELINE_MAX_PAGES is reached.
+    """
+    run_ids: List[RunId] = []
+    acc: List[Artifact] = []
+    for page in range(1, BASELINE_MAX_PAGES + 1):
+        resp = await CLIENT.get(
+            f"{GITHUB_API_URL}/repos/{org}/{repo}/actions/runs",
+            params={
+                "branch": branch,
+                "event": "push",
+                "status": "completed",
+                "per_page": RUNS_PER_PAGE,
+                "page": page,
+            },
+            headers=await AUTH.header(org, repo),
+            urgent=False,
+        )
+        resp.raise_for_status()
+        wrs = WorkflowRun.from_json_list(resp.json()["workflow_runs"])
+        # cancelled runs only have part of the reports.
+        candidates = [w for w in wrs if w.conclusion in ("success", "failure")]
+        # only list the artifacts of as many runs as we still miss at a time.
+        while candidates and len(run_ids) < BASELINE_RUNS:
+            batch = candidates[: BASELINE_RUNS - len(run_ids)]
+            candidates = candidates[len(batch) :]
+            found = await list_reports(org, repo, batch, None, label=branch)
+            with_reports = {a.workflow_run.id for a in found}
+            run_ids += [RunId(w.id) for w in batch if w.id in with_reports]
+            acc += found
+        if len(run_ids) >= BASELINE_RUNS or len(wrs) < RUNS_PER_PAGE:
+            break
+    return run_ids, acc
+
+
+async def refresh_baseline(org: str, repo: str, branch: str, send) -> None:
+    """
+    Ingest the artifacts of the most recent completed push runs of ``branch``
+    (see baseline_reports), and recompute its baseline from them.
+
+    Runs in the background (see FLIGHTS), so that comparing a PR never waits
+    on the artifacts of the base branch.
+    """
+    async with LOCKS.hold(f"baseline {org}/{repo} {branch}"):
+        try:
+            run_ids, acc = await baseline_reports(org, repo, branch)
+            state = await get_baseline_state(org, repo, branch)
+            if state is not None and sorted(state[0]) == sorted(run_ids):
+                log.info("Baseline of %s/%s %s is up to date", org, repo, branch)
+            else:
+                await fetch_report_tables(org, repo, acc, branch, send)
+            await put_baseline(org, repo, branch, run_ids)
+        except Exception as e:
+            log.exception("Failed to compute baseline of %s/%s %s", org, repo, branch)
+            send("error", f"Failed to compute baseline: {e}")
+
+
+# in progress ingestions, by (org, repo, head sha), and baseline refreshes, by
+# ("baseline", org, repo, branch)
+FLIGHTS = SingleFlight()
+
+
+# secret of the GitHub App webhook, webhooks are refused when it is not set.
+WEBHOOK_SECRET = environ.get("WEBHOOK_SECRET")
+
+
+@app.route("/api/webhook", methods=["POST"])
+async def webhook():
+    """
+    GitHub App webhook. When a workflow run of a PR completes, queue the
+    ingestion of its head (see jobs.py), so that the PR is ready when viewed.
+
+    Runs of PRs from forks have no ``pull_requests`` in the event, those are
+    still only ingested when viewed.
+    """
+    body = await request.get_data()
+    if WEBHOOK_SECRET is None:
+        return Response(json.dumps({"error": "webhooks are disabled"}), status=503)
+    digest = hmac.new(WEBHOOK_SECRET.encode(), body, sha256).hexdigest()
+    signature = request.headers.get("X-Hub-Signature-256", "")
+    if not hmac.compare_digest(f"sha256={digest}", signature):
+        return Response(json.dumps({"error": "invalid signature"}), status=401)
+
+    event = json.loads(body)
+    if (
+        request.headers.get("X-GitHub-Event") != "workflow_run"
+        or event.get("action") != "completed"
+    ):
+        return json.dumps({"queued": 0})
+    run = event["workflow_run"]
+    org = event["repository"]["owner"]["login"]
+    repo = event["repository"]["name"]
+    numbers = [pr["number"] for pr in run.get("pull_requests", [])]
+    for number in numbers:
+        await record_action_runs(
+            org, repo, number, [RunId(run["id"])], CommitSha(run["head_sha"])
+        )
+        await QUEUE.enqueue(org, repo, number, run["head_branch"], run["head_sha"])
+    log.info("Queued %s/%s %s for PRs %s", org, repo, run["head_sha"], numbers)
+    return json.dumps({"queued": len(numbers)})
+
+
+async def run_job(job: Job) -> Optional[str]:
+    """
+    Ingest the head of a PR for the job queue, through the same flight as its
+    viewers if any. Returns the error if it failed.
+    """
+    org, repo = job.organization, job.repo
+    flight = FLIGHTS.join(
+        (org, repo, job.head_sha),
+        app.nursery,
+        ingest_head,
+        org,
+        repo,
+        str(job.pull_number),
+        Head(job.head_ref, CommitSha(job.head_sha)),
+    )
+    async for kind, *payload in flight.subscribe():
+        if kind == "error":
+            return payload[0]
+    return None
 
-pkl = Path("./.cache.pkl.db")
-if pkl.exists():
-    log.warning("USING SHELVE")
-    CACHE = shelve.open(".cache.pkl")  # type: ignore
-    SYNC = True
-else:
-    log.debug("NOT USING SHELVE", pkl, "does not extis")
-    CACHE = {}  # type: ignore
-    SYNC = False
+
+async def ingest_worker():
+    # GitHub calls made for the queue give way to the ones made for viewers.
+    URGENT.set(False)
+    await QUEUE.work(run_job)
+
+
+@app.before_serving
+async def start_workers():
+    for _ in range(INGEST_WORKERS):
+        app.nursery.start_soon(ingest_worker)
 
 
 @app.route("/api/gh/<org>/<repo>/pull/<number>")
@@ -334,19 +1040,44 @@ async def api_pull(org: str, repo: str, number: str):
     Server sent event that should finally yield the json data for the data of
     the relevant PR
 
+    With ``?mode=stream``, the data of each report file is sent in its own
+    ``file_data`` event as soon as it is ready, instead of in a single
+    ``test_data`` event at the end.
 
+    With ``?format=compact``, the tables are not sent in the stream, instead
+    ``compact`` events give the url of the binary encoded tables (see
+    ``wire.py``), one per artifact in streaming mode, one in total otherwise.
     """
     assert org.isalnum()
     assert repo.isalnum()
     assert number.isnumeric()
+    stream = request.args.get("mode", "full") == "stream"
+    compact = request.args.get("format", "json") == "compact"
+    tracing = "trace" in request.args
 
     async def gen_api_pull(org, repo, number):
+        SSE_STREAMS.inc()
+        trace = start_trace() if tracing else None
+        try:
+            async for event in _gen_api_pull(org, repo, number):
+                yield event
+            if trace is not None:
+                yield ServerSentEvent(json.dumps({"trace": trace.to_json()})).encode()
+            yield ServerSentEvent(
+                json.dumps({"close": True, "info": "closing connection"})
+            ).encode()
+        finally:
+            SSE_STREAMS.dec()
+
+    async def _gen_api_pull(org, repo, number):
         log.warning("API Pull")
         assert org.isalnum()
         assert repo.isalnum()
         assert number.isnumeric()
-        url = f"https://api.github.com/repos/{org}/{repo}/pulls/{number}"
-        pr_data = requests.get(url, headers=AUTH.header).json()
+        url = f"{GITHUB_API_URL}/repos/{org}/{repo}/pulls/{number}"
+        with stage("pr_lookup"):
+            headers = await AUTH.header(org, repo)
+            pr_data = (await CLIENT.get(url, headers=headers)).json()
         if "head" not in pr_data:
             log.warning("NO Head : %s", pr_data.keys())
             log.warning(f"URL: {url} wont work", json.dumps(pr_data))
@@ -356,95 +1087,66 @@ async def api_pull(org: str, repo: str, number: str):
         pr = PullRequest.from_json(pr_data)
         head = pr.head
 
-        wrs: List[WorkflowRun] = await collect_most_recent_workflow_runs(
-            org, repo, head.ref, head.sha
+        with stage("head_summary"):
+            artifact_ids = await get_head_summary(org, repo, head.sha)
+            tables = None
+            if artifact_ids is not None:
+                tables = await get_report_tables(artifact_ids)
+        if artifact_ids is not None and tables is not None:
+            log.info("Serving %s from parsed report cache", head.sha)
+            if compact:
+                if artifact_ids:
+                    yield compact_event(artifact_ids)
+            elif stream:
+                for event in file_data_events(tables):
+                    yield event
+            else:
+                yield test_data_event(tables)
+            return
+
+        flight = FLIGHTS.join(
+            (org, repo, head.sha), app.nursery, ingest_head, org, repo, number, head
         )
-
-        log.warning("Looking for Artifacts...")
-        yield ServerSentEvent(
-            json.dumps({"info": "Looking for GH artifacts..."})
-        ).encode()
-        log.debug("Workflow runs id: %r", [(w.id, w.head_sha) for w in wrs])
-
-        for w in wrs:
-            await collect_artifact_metadata(org, repo, int(number), RunId(str(w.id)))
-        acc = await list_artifacts_urls_to_download(wrs, head.sha, number)
-        log.debug("artefacts to download: %s", acc)
-
-        yield ServerSentEvent(
-            json.dumps({"info": f"Requesting list of artifact from GH..."})
-        ).encode()
-
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            data = {}
-            la = len(acc)
-            for i, archive in enumerate(acc):
-                log.warning(f"Requesting Content... %s ({number})", i)
-                log.debug("archive %s", archive)
-                if archive in CACHE:
-                    log.debug("CACHE HIT")
-                    content = CACHE[archive]
-                else:
-                    log.debug("Sending SSE")
-                    yield ServerSentEvent(
-                        json.dumps({"info": f"Downloading artifacts {i+1}/{la}..."})
-                    ).encode()
-                    log.info("Downloading artifact...")
-                    zp = await client.get(archive, headers=AUTH.header)
-                    log.debug("Downloaded...")
-                    yield ServerSentEvent(
-                        json.dumps({"info": f"Got artifacts {i+1}/{la}..."})
-                    ).encode()
-                    log.warning(f"Unzipping in memory... %s ({number})", i)
-                    zp.raise_for_status()
-                    content = zp.content
-                    log.debug("PUT IN CACHE %s", archive)
-                    CACHE[archive] = content
-                    if SYNC:
-                        CACHE.sync()
-                yield ServerSentEvent(
-                    json.dumps({"info": f"Extracting artifact {i+1}..."})
-                ).encode()
-                z = ZipFile(BytesIO(content))
-                lll = len(z.filelist)
-                for j, fx in enumerate(z.filelist):
+        acc: List[int] = []
+        # only kept when we send everything at the end.
+        results: Dict[int, Dict[str, str]] = {}
+        async for kind, *payload in flight.subscribe():
+            if kind == "artifacts":
+                acc = payload[0]
+            elif kind == "tables":
+                i, n_files = payload
+                if compact:
+                    if n_files and stream:
+                        yield compact_event([acc[i]])
+                    elif n_files:
+                        # only the id is needed, not the tables.
+                        results[i] = {}
+                    continue
+                tables = await get_report_tables([acc[i]]) if n_files else {}
+                if tables is None:
                     yield ServerSentEvent(
-                        json.dumps({"info": f"Processing file {i+1}-{j+1}/{lll}..."})
+                        json.dumps({"info": f"Could not read artifact {acc[i]}"})
                     ).encode()
-
-                    gc.collect()
-
-                    log.warning(f"rezip... %s/%s %s ({number})", j, len(z.filelist), fx)
-                    z_read = z.read(fx)
-                    xs = json.loads(z_read)
-                    del z_read
-                    xs_tests = xs["tests"]
-                    comp_test = []
-
-                    for item in xs_tests:
-                        if "outcome" in item and item["outcome"] == "skipped":
-                            continue
-                        if "call" in item:
-                            comp_test.append(
-                                (
-                                    item["nodeid"],
-                                    item["call"]["duration"],
-                                    item["setup"]["duration"],
-                                    item["teardown"]["duration"],
-                                )
-                            )
-                        else:
-                            log.warning("unhandled item %r", item)
-
-                    del xs
-                    ## keep only what's necessary
-                    data[fx.filename] = {"comp": comp_test}
-
-        yield ServerSentEvent(json.dumps({"info": "Data ready, sending..."})).encode()
-        yield ServerSentEvent(json.dumps({"test_data": data, "info": "done"})).encode()
-        yield ServerSentEvent(
-            json.dumps({"close": True, "info": "closing connection"})
-        ).encode()
+                elif stream:
+                    for event in file_data_events(tables):
+                        yield event
+                else:
+                    results[i] = tables
+            else:
+                yield ServerSentEvent(json.dumps({"info": payload[0]})).encode()
+
+        if compact and not stream:
+            if results:
+                yield compact_event([acc[i] for i in sorted(results)])
+        elif not stream:
+            # same order as the artifacts, not as the downloads finished.
+            data: Dict[str, str] = {}
+            for i in sorted(results):
+                data.update(results[i])
+            yield ServerSentEvent(
+                json.dumps({"info": "Data ready, sending..."})
+            ).encode()
+            yield test_data_event(data)
         # log.warning("json serialise")
         # rz = json.dumps(data)
         # log.warning("sending... %s Mb", len(rz) / 1024 / 1024)
@@ -461,20 +1163,220 @@ async def api_pull(org: str, repo: str, number: str):
     return resp
 
 
+async def load_pull_tables(
+    org: str, repo: str, number: str
+) -> Tuple[Optional[PullRequest], List[int], Optional[Dict[str, str]]]:
+    """
+    The pull request, and the artifacts and tables of its head if all its
+    artifacts have already been ingested.
+    """
+    url = f"{GITHUB_API_URL}/repos/{org}/{repo}/pulls/{number}"
+    pr_data = (await CLIENT.get(url, headers=await AUTH.header(org, repo))).json()
+    if "head" not in pr_data:
+        return None, [], None
+    pr = PullRequest.from_json(pr_data)
+    artifact_ids = await get_head_summary(org, repo, pr.head.sha)
+    if artifact_ids is None:
+        return pr, [], None
+    return pr, artifact_ids, await get_report_tables(artifact_ids)
+
+
+# most recently used frames, so that drilling down does not rebuild them. They
+# are keyed by artifact ids rather than head sha, as a head gets more artifacts
+# when a run is re-run or uploads its reports.
+FRAMES: "OrderedDict[Tuple[int, ...], Frame]" = OrderedDict()
+FRAMES_SIZE = 8
+
+
+async def get_frame(artifact_ids: List[int], tables: Dict[str, str]) -> Frame:
+    key = tuple(sorted(artifact_ids))
+    if key not in FRAMES:
+        FRAMES[key] = await trio.to_thread.run_sync(
+            lambda: Frame.from_tables(
+                {member: json.loads(comp) for member, comp in tables.items()}
+            )
+        )
+        while len(FRAMES) > FRAMES_SIZE:
+            FRAMES.popitem(last=False)
+    FRAMES.move_to_end(key)
+    return FRAMES[key]
+
+
+@app.route("/api/gh/<org>/<repo>/pull/<number>/aggregate")
+async def api_aggregate(org: str, repo: str, number: str):
+    """
+    Timings of the PR aggregated across matrix files, see aggregate.py.
+
+    Query arguments are ``top`` (default 50) and ``sort`` (default p95) for the
+    lists of nodeids and test files, ``file`` to only list the nodeids of one
+    test file, and ``nodeid`` to get instead the raw rows of one test.
+    """
+    assert org.isalnum()
+    assert repo.isalnum()
+    assert number.isnumeric()
+    top = int(request.args.get("top", 50))
+    sort = request.args.get("sort", "p95")
+    if sort not in STATS + KINDS:
+        return Response(json.dumps({"error": f"Can't sort by {sort}"}), status=400)
+
+    pr, artifact_ids, tables = await load_pull_tables(org, repo, number)
+    if pr is None:
+        return Response(json.dumps({"error": "no head"}), status=404)
+    head = pr.head
+    if tables is None:
+        return Response(
+            json.dumps({"error": "not ingested yet", "head_sha": head.sha}),
+            status=404,
+        )
+    frame = await get_frame(artifact_ids, tables)
+
+    nodeid = request.args.get("nodeid")
+    if nodeid is not None:
+        result = {"nodeid": nodeid, "rows": rows_for(frame, nodeid)}
+    else:
+        test_file = request.args.get("file")
+        result = await trio.to_thread.run_sync(
+            lambda: summarize(frame, top, sort, test_file)
+        )
+    result["head_sha"] = head.sha
+    return json.dumps(result)
+
+
+# baselines loaded from postgres, with the run ids they were computed from.
+BASELINES: "OrderedDict[Tuple[str, str, str], Tuple[List[int], Baseline]]" = (
+    OrderedDict()
+)
+BASELINES_SIZE = 8
+
+
+async def load_baseline(org: str, repo: str, branch: str) -> Optional[Baseline]:
+    """
+    Baseline of ``branch``, starting a refresh in the background if it is
+    missing or too old.
+    """
+    state = await get_baseline_state(org, repo, branch)
+    if state is None or state[1] > BASELINE_MAX_AGE:
+        FLIGHTS.join(
+            ("baseline", org, repo, branch),
+            app.nursery,
+            refresh_baseline,
+            org,
+            repo,
+            branch,
+        )
+    if state is None:
+        return None
+    key = (org, repo, branch)
+    if key not in BASELINES or BASELINES[key][0] != state[0]:
+        rows = await get_baseline(org, repo, branch)
+        BASELINES[key] = (
+            state[0],
+            await trio.to_thread.run_sync(Baseline.from_rows, rows),
+        )
+        while len(BASELINES) > BASELINES_SIZE:
+            BASELINES.popitem(last=False)
+    BASELINES.move_to_end(key)
+    return BASELINES[key][1]
+
+
+@app.route("/api/gh/<org>/<repo>/pull/<number>/regressions")
+async def api_regressions(org: str, repo: str, number: str):
+    """
+    Tests of the PR that are significantly slower than on its base branch, see
+    regressions.py. ``top`` (default 50) limits the number of tests returned.
+
+    Answers 202 while the baseline of the base branch is being computed for the
+    first time.
+    """
+    assert org.isalnum()
+    assert repo.isalnum()
+    assert number.isnumeric()
+    top = int(request.args.get("top", 50))
+
+    pr, artifact_ids, tables = await load_pull_tables(org, repo, number)
+    if pr is None:
+        return Response(json.dumps({"error": "no head"}), status=404)
+    if tables is None:
+        return Response(
+            json.dumps({"error": "not ingested yet", "head_sha": pr.head.sha}),
+            status=404,
+        )
+    baseline = await load_baseline(org, repo, pr.base.ref)
+    if baseline is None:
+        return Response(
+            json.dumps({"status": "computing baseline", "base": pr.base.ref}),
+            status=202,
+        )
+    frame = await get_frame(artifact_ids, tables)
+    result = await trio.to_thread.run_sync(lambda: compare(frame, baseline, top))
+    result["head_sha"] = pr.head.sha
+    result["base"] = pr.base.ref
+    return json.dumps(result)
+
+
+@app.route("/api/compact/<artifact_ids>")
+async def api_compact(artifact_ids: str):
+    """
+    Tables of the given comma separated artifacts, in the compact binary format.
+
+    Artifacts never change, so neither does the response. Uploads (negative
+    ids, see put_upload) get more files when uploaded again, so they do.
+    """
+    ids = artifact_ids.split(",")
+    if not all(x.removeprefix("-").isnumeric() for x in ids):
+        return Response(json.dumps({"error": "invalid artifact ids"}), status=400)
+    tables = await get_report_tables([int(x) for x in ids])
+    if tables is None:
+        return Response(json.dumps({"error": "unknown artifact"}), status=404)
+
+    def encode():
+        comp = {member: json.loads(table) for member, table in tables.items()}
+        return gzip.compress(encode_compact(comp), compresslevel=6)
+
+    body = await trio.to_thread.run_sync(encode)
+    return Response(
+        body,
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Encoding": "gzip",
+            "Cache-Control": (
+                "no-cache"
+                if any(x.startswith("-") for x in ids)
+                else "public, max-age=31536000, immutable"
+            ),
+        },
+    )
+
+
+# serving processes, each with its own event loop, caches and parse pool, see
+# README.
+WORKERS = int(environ.get("WORKERS", 1))
+
+
 def main():
     port = int(os.environ.get("PORT", 1357))
     log.info("Seen config port %s", port)
     prod = os.environ.get("PROD", None)
     log.info("Prod= %s", prod)
-    try:
-        if prod or True:
-            app.run(port=port, host="0.0.0.0")
-        else:
-            app.run(port=port)
-    except KeyboardInterrupt:
-        log.info("CLOSING CACHE")
-        CACHE.close()
-        raise
+    if WORKERS > 1:
+        from hypercorn.config import Config
+        from hypercorn.run import run
+
+        config = Config()
+        config.application_path = "src.app:app"
+        config.worker_class = "trio"
+        config.workers = WORKERS
+        config.bind = [f"0.0.0.0:{port}"]
+        # share the cores between the parse pools of the workers.
+        cores = os.cpu_count() or 1
+        os.environ.setdefault("PARSE_WORKERS", str(max(1, cores // WORKERS)))
+        # and their metrics, see metrics.py.
+        os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="ptv-metrics-"))
+        run(config)
+    elif prod or True:
+        app.run(port=port, host="0.0.0.0")
+    else:
+        app.run(port=port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+"""
+On-disk store for downloaded artifact archives.
+
+Archives are stored as ``<artifact id>-<sha256>.zip`` in a single directory,
+under a total size budget: when it is exceeded, the least recently used
+archives are deleted. Recency survives restarts through the mtime of the
+files, which is bumped on every read.
+
+Archives are written to a temporary file while they are downloaded, and only
+renamed into place once complete, so a crash never leaves a truncated archive
+behind. They are read through ``mmap`` (see parsing.open_archive, as they are
+read by the parse workers, which don't need the store), so memory use does not
+grow with the size of the archives nor with how many of them have been viewed.
+Archives being read are pinned so that they are not evicted in the meantime.
+
+Several processes can share the directory: the files are the source of truth,
+the index of each process is refreshed from them before evicting. Pins hold a
+shared ``flock`` on the archive, and eviction only deletes archives it can
+lock exclusively, so an archive being read by another process is kept. The
+same goes for the temporary files of downloads in progress.
+"""
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from hashlib import sha256
+from os import environ
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_DIR = environ.get("ARTIFACT_DIR", ".artifacts")
+# total size of the archives kept on disk, in bytes.
+ARTIFACT_MAX_BYTES = int(environ.get("ARTIFACT_MAX_BYTES", 2 * 1024**3))
+
+
+class Writer:
+    """
+    Temporary file an archive is downloaded to, see ArtifactStore.writer.
+    """
+
+    def __init__(self, store: "ArtifactStore", artifact_id: int):
+        self.store = store
+        self.artifact_id = artifact_id
+        fd, name = tempfile.mkstemp(dir=store.root, suffix=".tmp")
+        # released when closed, see ArtifactStore._scan
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.path = Path(name)
+        self._file = os.fdopen(fd, "wb")
+        self._digest = sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    def reset(self) -> None:
+        """
+        Discard what was written so far, to write the archive again.
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self._digest = sha256()
+        self.size = 0
+
+    def commit(self) -> Path:
+        """
+        Add the archive to the store, pinned (see ArtifactStore.pin).
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        # still locked against eviction until pinned by the store.
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_SH)
+        try:
+            return self.store._add(
+                self.artifact_id, self.path, self._digest.hexdigest()
+            )
+        finally:
+            self._file.close()
+
+    def abort(self) -> None:
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class ArtifactStore:
+    """
+    Methods do blocking IO, call them from a thread.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+        # artifact id -> (path, size), least recently used first.
+        self._index: "OrderedDict[int, Tuple[Path, int]]" = OrderedDict()
+        # archives being read, that must not be evicted.
+        self._pinned: Counter = Counter()
+        # artifact id -> file descriptor holding a shared lock while pinned.
+        self._locks: Dict[int, int] = {}
+        self._size = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._scan()
+            log.info(
+                "Artifact store: %s archives, %s bytes", len(self._index), self._size
+            )
+            self._evict()
+
+    def _scan(self) -> None:
+        """
+        Rebuild the index from the directory, which other processes may have
+        changed.
+        """
+        found = []
+        for path in self.root.iterdir():
+            if path.suffix == ".tmp":
+                # left over by a download that did not complete
+                _unlink_unlocked(path)
+                continue
+            artifact_id, _, _ = path.stem.partition("-")
+            if path.suffix != ".zip" or not artifact_id.isdigit():
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            found.append((stat.st_mtime, int(artifact_id), path, stat.st_size))
+        self._index.clear()
+        self._size = 0
+        for _, artifact_id, path, size in sorted(found):
+            old = self._index.pop(artifact_id, None)
+            if old is not None:
+                # downloaded again, with different content
+                if _unlink_unlocked(old[0]):
+                    self._size -= old[1]
+            self._index[artifact_id] = (path, size)
+            self._size += size
+
+    def _evict(self) -> None:
+        # keep at least the most recent archive, however large.
+        candidates = [a for a in list(self._index)[:-1] if not self._pinned[a]]
+        for artifact_id in candidates:
+            if self._size <= self.max_bytes:
+                break
+            path, size = self._index[artifact_id]
+            if not _unlink_unlocked(path):
+                # being read by another process
+                continue
+            del self._index[artifact_id]
+            self._size -= size
+            self.counters["evictions"] += 1
+            log.info("Evicted artifact %s (%s bytes)", artifact_id, size)
+
+    def _add(self, artifact_id: int, tmp: Path, digest: str) -> Path:
+        path = self.root / f"{artifact_id}-{digest}.zip"
+        os.replace(tmp, path)
+        size = path.stat().st_size
+        with self._lock:
+            self._scan()
+            self._index.move_to_end(artifact_id)
+            self._pin(artifact_id, path)
+            self.counters["writes"] += 1
+            self.counters["bytes_written"] += size
+            self._evict()
+        return path
+
+    def _pin(self, artifact_id: int, path: Path) -> None:
+        if not self._pinned[artifact_id]:
+            fd = os.open(path, os.O_RDONLY)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            self._locks[artifact_id] = fd
+        self._pinned[artifact_id] += 1
+
+    def writer(self, artifact_id: int) -> Writer:
+        """
+        Temporary file to write an archive to, it is only added to the store
+        once ``commit()`` is called, or deleted by ``abort()``.
+        """
+        return Writer(self, artifact_id)
+
+    def pin(self, artifact_id: int) -> Optional[Path]:
+        """
+        Path of the archive, or None if we don't have it. It won't be evicted
+        until ``unpin`` is called, so that it can be read, possibly from other
+        processes, see parsing.open_archive.
+        """
+        with self._lock:
+            entry = self._index.get(artifact_id)
+            if entry is None or not entry[0].exists():
+                # maybe downloaded, or evicted, by another process.
+                self._scan()
+                entry = self._index.get(artifact_id)
+            try:
+                if entry is None:
+                    raise FileNotFoundError
+                self._pin(artifact_id, entry[0])
+            except FileNotFoundError:
+                self.counters["misses"] += 1
+                return None
+            self._index.move_to_end(artifact_id)
+        now = time.time()
+        os.utime(entry[0], (now, now))
+        self.counters["hits"] += 1
+        return entry[0]
+
+    def unpin(self, artifact_id: int) -> None:
+        with self._lock:
+            self._pinned[artifact_id] -= 1
+            if self._pinned[artifact_id] <= 0:
+                del self._pinned[artifact_id]
+                os.close(self._locks.pop(artifact_id))
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            self.counters,
+            files=len(self._index),
+            size=self._size,
+            max_size=self.max_bytes,
+        )
+
+
+def _unlink_unlocked(path: Path) -> bool:
+    """
+    Delete ``path`` unless another process holds a lock on it, return whether
+    it is gone.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    else:
+        path.unlink(missing_ok=True)
+        return True
+    finally:
+        os.close(fd)
+
+
+ARTIFACTS = ArtifactStore(Path(ARTIFACT_DIR), ARTIFACT_MAX_BYTES)
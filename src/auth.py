@@ -1,33 +1,290 @@
-from datetime import datetime, timedelta
-import pytz
+"""
+GitHub App authentication, for every installation of the app.
+
+Nothing here touches the network, nor even reads the app key, on import.
+``start`` runs once the app serves: it lists the installations, to know which
+one to use for each organization, and gets tokens for the ones used before
+the last restart, in the background so that the port is bound without
+waiting for GitHub.
+
+Each installation token is then renewed by its own background task a few
+minutes before it expires, so ``header`` is a dict lookup: only the first
+request for an organization we have never seen waits, for the lookup of its
+installation and its first token.
+
+Installation tokens are valid for an hour. They are kept in
+``AUTH_TOKEN_FILE`` and reused after a restart until they expire.
+
+``ActionsTokens`` checks the other way around: that a request comes from a
+given GitHub Actions job, with the OIDC token GitHub gives the job.
+"""
+import json
+import logging
+import os
+import time
+from base64 import b64decode, urlsafe_b64decode
+from dataclasses import dataclass, field
+from hashlib import sha512
+from os import environ
+from pathlib import Path
+from typing import Any, Dict, Optional, Set
+
+import jwt
+import trio
 from dateutil.parser import isoparse
-import requests
+
+from .client import BUDGET_HEADER, CLIENT, GITHUB_API_URL
+from .metrics import stage
+
+log = logging.getLogger(__name__)
+
+# where installation tokens are kept between restarts.
+AUTH_TOKEN_FILE = environ.get("AUTH_TOKEN_FILE", ".github_token.json")
+# issuer of the OIDC tokens of GitHub Actions jobs.
+ACTIONS_ISSUER = environ.get(
+    "ACTIONS_OIDC_ISSUER", "https://token.actions.githubusercontent.com"
+)
+# audience jobs ask their OIDC token for, see upload.py.
+ACTIONS_AUDIENCE = "pytest-viewer"
+
+# lifetime of the JWTs signed with the app key.
+VALIDITY = 60
+# renew tokens this long, in seconds, before they expire.
+REFRESH_AHEAD = 5 * 60
+# wait before trying again when a renewal failed.
+RETRY_DELAY = 10
+# stop using tokens this long before they expire.
+MARGIN = 10
+
+ACCEPT = "application/vnd.github.v3+json"
+
+
+@dataclass
+class Token:
+    token: str
+    # unix time
+    expires_at: float
+    header: Dict[str, str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.header = {"Authorization": f"token {self.token}", "Accept": ACCEPT}
+
+    def expired(self) -> bool:
+        return self.expires_at - MARGIN < time.time()
 
 
 class Auth:
-    def __init__(self, access_token_url, bt):
-        self._access_token_url = access_token_url
-        self._bt = bt
-        self._idata = None
-        self._regen()
-
-    def _regen(self):
-        headers = {
-            "Authorization": f"Bearer {self._bt()}",
-            "Accept": "application/vnd.github.v3+json",
-        }
-        response = requests.post(self._access_token_url, data=b"", headers=headers)
-        self._idata = response.json()
-        print("new expires_at idata:", repr(self._idata))
-        self._expires = isoparse(self._idata["expires_at"]) - timedelta(seconds=10)
-
-    @property
-    def header(self):
-        now = datetime.now(pytz.UTC)
-        if self._expires < now:
-            print("Expired header, regenerate, (expires, now)", self._expires, now)
-            self._regen()
+    def __init__(self, app_id: Optional[str], pem64: Optional[bytes], path: Path):
+        self._app_id = app_id
+        self._pem64 = pem64
+        self._path = path
+        self._key: Optional[jwt.AbstractJWKBase] = None
+        self._jwt = jwt.JWT()
+        self._lock = trio.Lock()
+        self._loaded = False
+        self._nursery: Optional[trio.Nursery] = None
+        # lower cased organization -> installation id
+        self._installations: Dict[str, int] = {}
+        self._tokens: Dict[int, Token] = {}
+        # installations with a renewal task
+        self._refreshing: Set[int] = set()
+
+    def bt(self) -> str:
+        """
+        JWT authenticating as the app itself.
+        """
+        if self._key is None:
+            pem = b64decode(self._pem64)  # type:ignore
+            log.info("APP_ID %s PEM DIGEST %s", self._app_id, sha512(pem).hexdigest())
+            self._key = jwt.jwk_from_pem(pem)
+        now = int(time.time())
+        payload = {"iat": now, "exp": now + VALIDITY, "iss": self._app_id}
+        return self._jwt.encode(payload, self._key, alg="RS256")
+
+    def _app_header(self) -> Dict[str, str]:
         return {
-            "Authorization": f"token {self._idata['token']}",
-            "Accept": "application/vnd.github.v3+json",
+            "Authorization": f"Bearer {self.bt()}",
+            "Accept": ACCEPT,
+            BUDGET_HEADER: "app",
         }
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            saved = json.loads(self._path.read_text())
+        except (OSError, ValueError):
+            return
+        # tokens of another app, or of another GitHub, are of no use.
+        if saved.get("app_id") != self._app_id or saved.get("api") != GITHUB_API_URL:
+            return
+        self._installations.update(saved.get("installations", {}))
+        for installation_id, token in saved.get("tokens", {}).items():
+            self._tokens[int(installation_id)] = Token(**token)
+        log.info("Loaded %s tokens from %s", len(self._tokens), self._path)
+
+    def _save(self) -> None:
+        data = {
+            "app_id": self._app_id,
+            "api": GITHUB_API_URL,
+            "installations": self._installations,
+            "tokens": {
+                i: {"token": t.token, "expires_at": t.expires_at}
+                for i, t in self._tokens.items()
+            },
+        }
+        # every serving process saves its tokens, don't write the same file.
+        tmp = self._path.with_suffix(f".{os.getpid()}.tmp")
+        # tokens give access to the repositories, only we may read them.
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self._path)
+
+    async def _list_installations(self) -> None:
+        resp = await CLIENT.get(
+            f"{GITHUB_API_URL}/app/installations",
+            params={"per_page": 100},
+            headers=self._app_header(),
+        )
+        resp.raise_for_status()
+        for installation in resp.json():
+            login = installation["account"]["login"].lower()
+            self._installations[login] = installation["id"]
+
+    async def _installation_id(self, org: str, repo: str) -> int:
+        installation_id = self._installations.get(org.lower())
+        if installation_id is None:
+            # installed since we listed them, or on a single repository.
+            resp = await CLIENT.get(
+                f"{GITHUB_API_URL}/repos/{org}/{repo}/installation",
+                headers=self._app_header(),
+            )
+            resp.raise_for_status()
+            installation_id = self._installations[org.lower()] = resp.json()["id"]
+        return installation_id
+
+    async def _regen(self, installation_id: int) -> Token:
+        with stage("auth_token"):
+            resp = await CLIENT.post(
+                f"{GITHUB_API_URL}/app/installations/{installation_id}/access_tokens",
+                headers=self._app_header(),
+            )
+            resp.raise_for_status()
+        idata = resp.json()
+        log.info(
+            "New token for installation %s, expires at %s",
+            installation_id,
+            idata["expires_at"],
+        )
+        token = Token(idata["token"], isoparse(idata["expires_at"]).timestamp())
+        self._tokens[installation_id] = token
+        await trio.to_thread.run_sync(self._save)
+        self._keep_fresh(installation_id)
+        return token
+
+    def _keep_fresh(self, installation_id: int) -> None:
+        if self._nursery is None or installation_id in self._refreshing:
+            return
+        self._refreshing.add(installation_id)
+        self._nursery.start_soon(self._refresh_loop, installation_id)
+
+    async def _refresh_loop(self, installation_id: int) -> None:
+        while True:
+            token = self._tokens[installation_id]
+            await trio.sleep(max(0, token.expires_at - REFRESH_AHEAD - time.time()))
+            try:
+                await self._regen(installation_id)
+            except Exception:
+                # the current token may still be valid for a while.
+                log.exception("Could not renew token of %s", installation_id)
+                await trio.sleep(RETRY_DELAY)
+
+    async def header(self, org: str, repo: str) -> Dict[str, str]:
+        """
+        Headers to call GitHub about ``org/repo``, without any IO unless we
+        don't have a valid token for its installation yet.
+        """
+        installation_id = self._installations.get(org.lower())
+        token = self._tokens.get(installation_id)  # type:ignore
+        if token is None or token.expired():
+            async with self._lock:
+                if not self._loaded:
+                    await trio.to_thread.run_sync(self._load)
+                installation_id = await self._installation_id(org, repo)
+                token = self._tokens.get(installation_id)
+                if token is None or token.expired():
+                    token = await self._regen(installation_id)
+                self._keep_fresh(installation_id)
+        # the rate limit is per installation, whichever token it has now.
+        return {**token.header, BUDGET_HEADER: str(installation_id)}
+
+    async def _warm_up(self) -> None:
+        try:
+            async with self._lock:
+                if not self._loaded:
+                    await trio.to_thread.run_sync(self._load)
+                await self._list_installations()
+                for installation_id, token in list(self._tokens.items()):
+                    if installation_id not in self._installations.values():
+                        # the app was uninstalled.
+                        del self._tokens[installation_id]
+                    elif token.expired():
+                        await self._regen(installation_id)
+                    else:
+                        self._keep_fresh(installation_id)
+        except Exception:
+            # requests will try again, and report the error.
+            log.exception("Could not get GitHub tokens")
+
+    def start(self, nursery: trio.Nursery) -> None:
+        """
+        Renew tokens in the background from now on, see the module docstring.
+        """
+        self._nursery = nursery
+        nursery.start_soon(self._warm_up)
+
+
+class ActionsTokens:
+    """
+    Verify the OIDC tokens of GitHub Actions jobs, whose claims say which
+    repository and run they were issued for.
+    """
+
+    def __init__(self, issuer: str, audience: str):
+        self._issuer = issuer
+        self._audience = audience
+        self._jwt = jwt.JWT()
+        # key id -> signing key of the issuer
+        self._keys: Dict[str, jwt.AbstractJWKBase] = {}
+
+    async def _fetch_keys(self) -> None:
+        resp = await CLIENT.get(f"{self._issuer}/.well-known/jwks")
+        resp.raise_for_status()
+        self._keys = {k["kid"]: jwt.jwk_from_dict(k) for k in resp.json()["keys"]}
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """
+        Claims of ``token``, raises ValueError unless it is valid.
+        """
+        try:
+            header = token.split(".")[0]
+            header += "=" * (-len(header) % 4)
+            kid = json.loads(urlsafe_b64decode(header))["kid"]
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("malformed token")
+        if kid not in self._keys:
+            # the issuer rotates its keys.
+            await self._fetch_keys()
+        key = self._keys.get(kid)
+        if key is None:
+            raise ValueError(f"unknown key {kid!r}")
+        try:
+            claims = self._jwt.decode(token, key, algorithms={"RS256"})
+        except jwt.exceptions.JWTException as e:
+            raise ValueError(str(e))
+        audience = claims.get("aud")
+        if isinstance(audience, str):
+            audience = [audience]
+        if claims.get("iss") != self._issuer or self._audience not in (audience or []):
+            raise ValueError("token issued by or for someone else")
+        return claims
@@ -0,0 +1,295 @@
+"""
+Shared HTTP client for all the calls to GitHub.
+
+A single httpx.AsyncClient lives as long as the app, so connections and TLS
+sessions are reused across handlers instead of being set up for every step of
+every request, using HTTP/2 when the server (and the h2 package) support it.
+
+On top of the global pool limit, the number of concurrent requests is limited
+per host, so that large artifact downloads cannot starve the API calls.
+
+JSON responses from the API are cached with their ETag / Last-Modified, and
+revalidated with conditional requests: a 304 does not count against the rate
+limit. We also keep track of the remaining rate limit budget of each
+installation (named by Auth in the BUDGET_HEADER of its requests), and once it
+gets low, requests that are not marked as urgent are spread over what is left
+of the rate limit window.
+"""
+import logging
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from os import environ
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+import trio
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+log = logging.getLogger(__name__)
+
+# GitHub Enterprise, or a local stand-in for benchmarks.
+GITHUB_API_URL = environ.get("GITHUB_API_URL", "https://api.github.com")
+MAX_CONNECTIONS = int(environ.get("HTTP_MAX_CONNECTIONS", 50))
+MAX_PER_HOST = int(environ.get("HTTP_MAX_PER_HOST", 20))
+TIMEOUT = float(environ.get("HTTP_TIMEOUT", 30))
+# number of API responses kept for conditional requests.
+ETAG_CACHE_SIZE = int(environ.get("HTTP_ETAG_CACHE_SIZE", 2000))
+# below this many remaining calls, non urgent requests are slowed down.
+RATE_LIMIT_RESERVE = int(environ.get("GITHUB_RATE_LIMIT_RESERVE", 500))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# default of ``urgent`` (see Client.request) for the current task, and the
+# tasks it starts, e.g. False for background workers.
+URGENT: ContextVar[bool] = ContextVar("urgent", default=True)
+
+# names the rate limit budget a request counts against, e.g. an installation
+# whatever its current token. Removed before the request is sent.
+BUDGET_HEADER = "X-Rate-Budget"
+
+# headers that describe the encoding on the wire, not the cached content.
+_WIRE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+@dataclass
+class _CacheEntry:
+    headers: Dict[str, str]
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # time.monotonic() until which we can use the entry without revalidating.
+    fresh_until: float
+
+    def response(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, headers=self.headers, content=self.content, request=request
+        )
+
+
+def _max_age(headers: httpx.Headers) -> int:
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age" and value.isdigit():
+            return int(value)
+    return 0
+
+
+@dataclass
+class RateBudget:
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    reset: float = 0
+
+    def update(self, headers: httpx.Headers) -> None:
+        if "x-ratelimit-remaining" not in headers:
+            return
+        self.limit = int(headers["x-ratelimit-limit"])
+        self.remaining = int(headers["x-ratelimit-remaining"])
+        self.reset = float(headers["x-ratelimit-reset"])
+
+    def delay(self) -> float:
+        """
+        How long a non urgent request should wait before being sent.
+        """
+        now = time.time()
+        if self.remaining is None or self.reset <= now:
+            return 0
+        if self.remaining <= 0:
+            return self.reset - now
+        if self.remaining < RATE_LIMIT_RESERVE:
+            return (self.reset - now) / self.remaining
+        return 0
+
+
+class Client:
+    def __init__(self, max_connections: int, max_per_host: int, timeout: float):
+        self._client = httpx.AsyncClient(
+            http2=HTTP2,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(timeout),
+        )
+        self._max_per_host = max_per_host
+        self._limiters: Dict[str, trio.CapacityLimiter] = {}
+        self._cache: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._budgets: Dict[str, RateBudget] = {}
+        # non urgent requests wait their turn here when the budget is low.
+        self._slow_lane = trio.Lock()
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.cache: Counter = Counter()
+
+    def _limiter(self, host: str) -> trio.CapacityLimiter:
+        if host not in self._limiters:
+            self._limiters[host] = trio.CapacityLimiter(self._max_per_host)
+        return self._limiters[host]
+
+    def _budget(self, headers: Dict[str, str]) -> RateBudget:
+        """
+        Budget of a request, whose ``BUDGET_HEADER`` is removed from
+        ``headers``.
+        """
+        key = headers.pop(BUDGET_HEADER, "anonymous")
+        return self._budgets.setdefault(key, RateBudget())
+
+    def _store(self, key: str, resp: httpx.Response) -> None:
+        etag = resp.headers.get("etag")
+        last_modified = resp.headers.get("last-modified")
+        if etag is None and last_modified is None:
+            return
+        if "json" not in resp.headers.get("content-type", ""):
+            # don't keep artifact archives in memory.
+            return
+        self._cache[key] = _CacheEntry(
+            headers={
+                k: v for k, v in resp.headers.items() if k.lower() not in _WIRE_HEADERS
+            },
+            content=resp.content,
+            etag=etag,
+            last_modified=last_modified,
+            fresh_until=time.monotonic() + _max_age(resp.headers),
+        )
+        self._cache.move_to_end(key)
+        while len(self._cache) > ETAG_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        urgent: Optional[bool] = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """
+        Send a request, through the cache for GETs.
+
+        Requests with ``urgent=False`` are delayed when the rate limit budget of
+        their installation is running low, so that what is left goes to user facing
+        requests.
+        """
+        host = urlsplit(url).hostname or ""
+        headers = dict(kwargs.pop("headers", None) or {})
+        budget = self._budget(headers)
+        if urgent is None:
+            urgent = URGENT.get()
+        if not urgent and budget.delay():
+            async with self._slow_lane:
+                delay = budget.delay()
+                log.info("Low rate limit budget, delaying %s by %.1fs", url, delay)
+                self.cache["delayed"] += 1
+                await trio.sleep(delay)
+
+        key = str(httpx.URL(url, params=kwargs.get("params")))
+        entry = self._cache.get(key) if method == "GET" else None
+        if entry is not None:
+            if entry.fresh_until > time.monotonic():
+                self.cache["hits"] += 1
+                return entry.response(httpx.Request(method, key))
+            if entry.etag is not None:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified is not None:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        async with self._limiter(host):
+            self.requests[host] += 1
+            try:
+                resp = await self._client.request(
+                    method, url, headers=headers, **kwargs
+                )
+            except httpx.HTTPError:
+                self.errors[host] += 1
+                raise
+        budget.update(resp.headers)
+
+        if entry is not None and resp.status_code == 304:
+            self.cache["not_modified"] += 1
+            entry.fresh_until = time.monotonic() + _max_age(resp.headers)
+            self._cache.move_to_end(key)
+            return entry.response(resp.request)
+        if method == "GET" and resp.status_code == 200:
+            self.cache["misses"] += 1
+            self._store(key, resp)
+        return resp
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """
+        GET ``url``, the body being read from the response as it arrives. Not
+        cached.
+        """
+        host = urlsplit(url).hostname or ""
+        headers = dict(kwargs.pop("headers", None) or {})
+        budget = self._budget(headers)
+        async with self._limiter(host):
+            self.requests[host] += 1
+            try:
+                async with self._client.stream(
+                    "GET", url, headers=headers, **kwargs
+                ) as resp:
+                    budget.update(resp.headers)
+                    yield resp
+            except httpx.HTTPError:
+                self.errors[host] += 1
+                raise
+
+    async def download(
+        self, url: str, write: Callable[[bytes], None], **kwargs
+    ) -> None:
+        """
+        GET ``url``, passing the body to ``write`` (called in a thread) as it
+        arrives instead of holding it in memory. Not cached.
+        """
+        async with self.stream(url, **kwargs) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                await trio.to_thread.run_sync(write, chunk)
+
+    def stats(self) -> Dict[str, Any]:
+        # the connection pool is not public API, don't fail if it changes.
+        pool = getattr(self._client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        return {
+            "http2": HTTP2,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "in_flight": {
+                host: limiter.borrowed_tokens
+                for host, limiter in self._limiters.items()
+            },
+            "cache": dict(self.cache, size=len(self._cache)),
+            "rate_limit": {
+                key: {
+                    "limit": budget.limit,
+                    "remaining": budget.remaining,
+                    "reset": budget.reset,
+                }
+                for key, budget in self._budgets.items()
+            },
+        }
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+CLIENT = Client(MAX_CONNECTIONS, MAX_PER_HOST, TIMEOUT)
@@ -9,7 +9,9 @@ When possbile we use the newtype pattern to make sure that we don't mix up the t
 """
 
 from dataclasses import dataclass, fields
-from typing import NewType, List, Dict, Any, Optional
+from functools import cache
+from operator import itemgetter
+from typing import NewType, List, Dict, Any, Callable, Iterable, Optional
 
 
 CommitSha = NewType("CommitSha", str)
@@ -18,38 +20,75 @@ PullRequestNumber = NewType("PullRequestNumber", int)
 
 
 class _Base:
+    # so that the slots of the dataclasses are the only storage.
+    __slots__ = ()
+
     @classmethod
     def from_json(cls, data):
         """
         For now drop fields we do not need
         """
-        f_data = {}
-        fields_names = [f.name for f in fields(cls)]
-        for key in data.keys():
-            if key in fields_names:
-                f = [f for f in fields(cls) if f.name == key][0]
-                if isinstance(f.type, type) and issubclass(f.type, _Base):
-                    f_data[f.name] = f.type.from_json(data[f.name])
-                else:
-                    f_data[f.name] = data[f.name]
+        return _decoder(cls)(data)
+
+    @classmethod
+    def from_json_list(cls, items: Iterable[Dict[str, Any]]) -> List[Any]:
+        """
+        from_json of each item, e.g. of a whole page of results.
+        """
+        decode = _decoder(cls)
+        return [decode(data) for data in items]
+
 
-        return cls(**{name: f_data[name] for name in f_data.keys()})
+@cache
+def _decoder(cls) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Function making a ``cls`` from its JSON.
 
+    Which keys to read, and which of them are nested types, only depends on
+    the class, so it is worked out once here rather than for every object.
+    """
+    names = [f.name for f in fields(cls)]
+    nested = [
+        (i, _decoder(f.type))
+        for i, f in enumerate(fields(cls))
+        if isinstance(f.type, type) and issubclass(f.type, _Base)
+    ]
+    # itemgetter of a single key does not return a tuple.
+    get = itemgetter(*names) if len(names) > 1 else lambda data: (data[names[0]],)
 
-@dataclass
+    if not nested:
+        return lambda data: cls(*get(data))
+
+    def decode(data):
+        values = list(get(data))
+        for i, decode_nested in nested:
+            values[i] = decode_nested(values[i])
+        return cls(*values)
+
+    return decode
+
+
+@dataclass(slots=True)
 class Head(_Base):
     ref: str
     sha: CommitSha
 
 
-@dataclass
+@dataclass(slots=True)
+class Base(_Base):
+    ref: str
+    sha: CommitSha
+
+
+@dataclass(slots=True)
 class PullRequest(_Base):
     number: PullRequestNumber
     title: str
     head: Head
+    base: Base
 
 
-@dataclass
+@dataclass(slots=True)
 class WorkflowRun(_Base):
     id: int
     name: str
@@ -62,3 +101,19 @@ class WorkflowRun(_Base):
     created_at: str
     updated_at: str
     artifacts_url: CommitSha
+
+
+@dataclass(slots=True)
+class ArtifactWorkflowRun(_Base):
+    id: RunId
+    head_branch: str
+    head_sha: CommitSha
+
+
+@dataclass(slots=True)
+class Artifact(_Base):
+    id: int
+    name: str
+    size_in_bytes: int
+    archive_download_url: str
+    workflow_run: ArtifactWorkflowRun
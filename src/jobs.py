@@ -0,0 +1,178 @@
+"""
+Durable queue of ingestion jobs, in postgres.
+
+Webhooks enqueue the head of a PR when one of its workflow runs completes,
+background workers then ingest it ahead of the first view. Jobs are
+deduplicated by head: enqueuing a head again only moves it to the front of
+the queue, most recently active PRs being ingested first.
+
+Workers claim a job with ``FOR UPDATE SKIP LOCKED`` and hold it for
+``JOB_LEASE`` seconds, after which a job whose worker died is claimed again.
+Failed jobs are retried with an exponential backoff, up to
+``JOB_MAX_ATTEMPTS`` times.
+
+A job enqueued again while it runs (another run of the same head completed
+meanwhile) is not removed when it finishes, so it is run once more.
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from os import environ
+from typing import Awaitable, Callable, Optional
+
+import trio
+
+from .metrics import Counter
+from .postgres import db_run
+
+log = logging.getLogger(__name__)
+
+# number of background ingestion workers, 0 to disable them.
+INGEST_WORKERS = int(environ.get("INGEST_WORKERS", 2))
+# seconds a worker holds a job before someone else may pick it up.
+JOB_LEASE = int(environ.get("JOB_LEASE", 15 * 60))
+JOB_MAX_ATTEMPTS = int(environ.get("JOB_MAX_ATTEMPTS", 5))
+# seconds between polls of an empty queue, jobs enqueued by this process wake
+# the workers up right away.
+POLL_INTERVAL = 30
+
+JOBS = Counter(
+    "ptv_ingest_jobs_total", "Background ingestion jobs, by outcome.", ["outcome"]
+)
+
+
+@dataclass
+class Job:
+    id: int
+    organization: str
+    repo: str
+    pull_number: int
+    head_ref: str
+    head_sha: str
+    enqueued_at: datetime
+    attempts: int
+
+
+class Queue:
+    def __init__(self):
+        self._wake = trio.Event()
+
+    async def enqueue(
+        self, org: str, repo: str, pull_number: int, head_ref: str, head_sha: str
+    ) -> None:
+        def put(cursor):
+            cursor.execute(
+                """
+                INSERT INTO ingest_job
+                    (organization, repo, pull_number, head_ref, head_sha)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (organization, repo, pull_number, head_sha) DO UPDATE
+                SET enqueued_at = now(), run_after = now(), attempts = 0,
+                    last_error = NULL
+                """,
+                (org, repo, pull_number, head_ref, head_sha),
+            )
+
+        await db_run(put)
+        JOBS.inc(outcome="enqueued")
+        wake, self._wake = self._wake, trio.Event()
+        wake.set()
+
+    async def claim(self) -> Optional[Job]:
+        def get(cursor):
+            cursor.execute(
+                """
+                UPDATE ingest_job
+                SET locked_until = now() + make_interval(secs => %s),
+                    attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM ingest_job
+                    WHERE run_after <= now()
+                        AND (locked_until IS NULL OR locked_until < now())
+                        AND attempts < %s
+                    ORDER BY enqueued_at DESC
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, organization, repo, pull_number, head_ref, head_sha,
+                    enqueued_at, attempts
+                """,
+                (JOB_LEASE, JOB_MAX_ATTEMPTS),
+            )
+            row = cursor.fetchone()
+            return None if row is None else Job(*row)
+
+        return await db_run(get)
+
+    async def finish(self, job: Job) -> None:
+        def done(cursor):
+            cursor.execute(
+                """
+                DELETE FROM ingest_job WHERE id = %s AND enqueued_at = %s
+                """,
+                (job.id, job.enqueued_at),
+            )
+            if cursor.rowcount == 0:
+                # enqueued again meanwhile, let it run again.
+                cursor.execute(
+                    "UPDATE ingest_job SET locked_until = NULL WHERE id = %s",
+                    (job.id,),
+                )
+
+        await db_run(done)
+        JOBS.inc(outcome="done")
+
+    async def retry(self, job: Job, error: str) -> None:
+        delay = 60 * 2 ** (job.attempts - 1)
+
+        def fail(cursor):
+            cursor.execute(
+                """
+                UPDATE ingest_job
+                SET locked_until = NULL, last_error = %s,
+                    run_after = now() + make_interval(secs => %s)
+                WHERE id = %s
+                """,
+                (error, delay, job.id),
+            )
+
+        await db_run(fail)
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            log.error("Giving up on %s after %s attempts: %s", job, job.attempts, error)
+            JOBS.inc(outcome="failed")
+        else:
+            log.warning("Job %s failed, retrying in %ss: %s", job.id, delay, error)
+            JOBS.inc(outcome="retried")
+
+    async def work(self, handle: Callable[[Job], Awaitable[Optional[str]]]) -> None:
+        """
+        Run jobs forever, ``handle(job)`` returns an error message if it failed.
+        """
+        while True:
+            wake = self._wake
+            try:
+                job = await self.claim()
+            except Exception:
+                log.exception("Could not claim a job")
+                job = None
+            if job is None:
+                with trio.move_on_after(POLL_INTERVAL):
+                    await wake.wait()
+                continue
+            log.info("Running job %s", job)
+            try:
+                error = await handle(job)
+            except Exception as e:
+                log.exception("Job %s failed", job.id)
+                error = repr(e)
+            try:
+                if error is None:
+                    await self.finish(job)
+                else:
+                    await self.retry(job, error)
+            except Exception:
+                # the lease will expire, and the job run again.
+                log.exception("Could not update job %s", job.id)
+
+
+QUEUE = Queue()
@@ -0,0 +1,362 @@
+"""
+Metrics in the Prometheus text format, and per request traces.
+
+The ingestion pipeline is split in stages (PR lookup, run discovery, artifact
+listing, download, parse, ...), each one wrapped in ``stage(name)``, which
+records its duration in the ``ptv_stage_seconds`` histogram, and, when the
+request asked for it, as a span of the current trace (see ``start_trace``).
+
+The trace lives in a context variable, so stages of the background ingestion
+started by a request are part of its trace, since trio tasks inherit the
+context of the task that started them.
+
+Values that are already tracked elsewhere (HTTP client, artifact store, ...)
+are read when the metrics are rendered rather than duplicated, see the
+``callback`` of counters and gauges.
+
+When the app runs as several processes, each of them publishes its values in
+METRICS_DIR (see ``publish``), and whichever one is scraped renders them all:
+counters and histograms are summed, over processes that exited too, and gauges
+of the live processes are aggregated as each gauge says.
+"""
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from os import environ
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+# seconds, from cache hits to large downloads.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY: List["_Metric"] = []
+
+# shared by the processes serving the app, set by main() for them.
+METRICS_DIR = environ.get("METRICS_DIR")
+# seconds between publications of the values of a process.
+PUBLISH_INTERVAL = 10
+
+# values of a metric, as published: a list of [label values, value] for
+# counters and gauges, [label values, bucket counts, sum] for histograms.
+Snapshot = List[List[Any]]
+
+
+def _labels(names: Sequence[str], values: LabelValues, **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    # whether values of processes that exited still count.
+    cumulative = True
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def snapshot(self) -> Snapshot:
+        """
+        Values of this process, see ``Snapshot``.
+        """
+
+    @abstractmethod
+    def merge(self, snapshots: List[Snapshot]) -> Snapshot:
+        """
+        Values of all the processes, from their snapshots.
+        """
+
+    @abstractmethod
+    def samples(self, snapshot: Snapshot) -> List[str]:
+        """
+        Lines of the Prometheus text format for ``snapshot``.
+        """
+
+    def render(self, snapshot: Snapshot) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(snapshot),
+        ]
+
+
+class _Value(_Metric):
+    """
+    Either updated directly, or computed by ``callback`` when rendered, which
+    returns the values by label values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = defaultdict(float)
+        self._callback = callback
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        self._values[self._key(labels)] += value
+
+    def snapshot(self) -> Snapshot:
+        values = self._callback() if self._callback is not None else self._values
+        return [[list(key), value] for key, value in values.items()]
+
+    def _aggregate(self, values: List[float]) -> float:
+        return sum(values)
+
+    def merge(self, snapshots: List[Snapshot]) -> Snapshot:
+        values: Dict[LabelValues, List[float]] = defaultdict(list)
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                if value is not None:
+                    values[tuple(key)].append(value)
+        return [[list(key), self._aggregate(v)] for key, v in values.items()]
+
+    def samples(self, snapshot: Snapshot) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.labels, tuple(key))} {value}"
+            for key, value in snapshot
+        ]
+
+
+class Counter(_Value):
+    type = "counter"
+
+
+class Gauge(_Value):
+    """
+    ``aggregate`` combines the values of the processes: ``sum`` for what each
+    process has its own share of, ``max`` or ``min`` for what they all see.
+    """
+
+    type = "gauge"
+    cumulative = False
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+        aggregate: Callable[[List[float]], float] = sum,
+    ):
+        super().__init__(name, help, labels, callback)
+        self._combine = aggregate
+
+    def _aggregate(self, values: List[float]) -> float:
+        return self._combine(values)
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def dec(self, value: float = 1, **labels: str) -> None:
+        self._values[self._key(labels)] -= value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[key] += value
+
+    def snapshot(self) -> Snapshot:
+        return [
+            [list(key), counts, self._sums[key]] for key, counts in self._counts.items()
+        ]
+
+    def merge(self, snapshots: List[Snapshot]) -> Snapshot:
+        counts: Dict[LabelValues, List[int]] = {}
+        sums: Dict[LabelValues, float] = defaultdict(float)
+        for snapshot in snapshots:
+            for key, key_counts, key_sum in snapshot:
+                key = tuple(key)
+                total = counts.get(key, [0] * len(key_counts))
+                counts[key] = [a + b for a, b in zip(total, key_counts)]
+                sums[key] += key_sum
+        return [[list(key), c, sums[key]] for key, c in counts.items()]
+
+    def samples(self, snapshot: Snapshot) -> List[str]:
+        lines = []
+        for key, counts, key_sum in snapshot:
+            key = tuple(key)
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labels, key, le=le)} {total}"
+                )
+            labels = _labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {key_sum}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+def snapshot() -> Dict[str, Snapshot]:
+    """
+    Values of all the metrics of this process.
+    """
+    return {m.name: m.snapshot() for m in REGISTRY}
+
+
+def publish(snapshots: Dict[str, Snapshot]) -> None:
+    """
+    Write the values of this process to METRICS_DIR, for the other processes
+    to render, see the module docstring.
+    """
+    path = Path(METRICS_DIR) / f"{os.getpid()}.json"  # type:ignore
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(snapshots))
+    os.replace(tmp, path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merged(snapshots: Dict[str, Snapshot]) -> Dict[str, Snapshot]:
+    """
+    Publish the values of this process, and return those of all of them, see
+    the module docstring.
+    """
+    publish(snapshots)
+    processes = []
+    for path in Path(METRICS_DIR).glob("*.json"):  # type:ignore
+        try:
+            processes.append((_alive(int(path.stem)), json.loads(path.read_text())))
+        except (OSError, ValueError):
+            # just replaced, or not ours.
+            continue
+    return {
+        m.name: m.merge(
+            [
+                values[m.name]
+                for alive, values in processes
+                if m.name in values and (alive or m.cumulative)
+            ]
+        )
+        for m in REGISTRY
+    }
+
+
+def render(snapshots: Optional[Dict[str, Snapshot]] = None) -> str:
+    if snapshots is None:
+        snapshots = snapshot()
+    lines = [line for m in REGISTRY for line in m.render(snapshots.get(m.name, []))]
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "ptv_stage_seconds", "Duration of each stage of the pipeline.", ["stage"]
+)
+STAGE_ERRORS = Counter(
+    "ptv_stage_errors_total", "Stages that raised an exception.", ["stage"]
+)
+DOWNLOADED_BYTES = Counter(
+    "ptv_downloaded_bytes_total", "Size of the artifact archives downloaded."
+)
+SSE_STREAMS = Gauge("ptv_sse_streams", "Event streams currently open.")
+
+
+@dataclass
+class Span:
+    name: str
+    # seconds since the start of the trace
+    start: float
+    duration: float
+    attrs: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    begin: float = field(default_factory=time.perf_counter)
+    spans: List[Span] = field(default_factory=list)
+
+    def to_json(self) -> List[Dict]:
+        return [
+            {
+                "name": s.name,
+                "start_ms": round(s.start * 1000, 3),
+                "duration_ms": round(s.duration * 1000, 3),
+                **s.attrs,
+            }
+            for s in sorted(self.spans, key=lambda s: s.start)
+        ]
+
+
+_TRACE: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def start_trace() -> Trace:
+    """
+    Record the stages of the current task, and of the tasks it starts, in a
+    new trace.
+    """
+    trace = Trace()
+    _TRACE.set(trace)
+    return trace
+
+
+@contextmanager
+def stage(name: str, **attrs: str) -> Iterator[None]:
+    begin = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        duration = time.perf_counter() - begin
+        STAGE_SECONDS.observe(duration, stage=name)
+        trace = _TRACE.get()
+        if trace is not None:
+            trace.spans.append(Span(name, begin - trace.begin, duration, attrs))
@@ -0,0 +1,136 @@
+"""
+Process pool for the CPU bound part of ingestion.
+
+Decompressing report files and parsing their JSON would otherwise run on the
+event loop (or in threads, holding the GIL), stalling every other request
+while a large PR is ingested. Instead each member of an archive is sent to one
+of PARSE_WORKERS processes, by path and name, and only its ``comp`` table comes
+back to the event loop.
+
+At most PARSE_WORKERS members are submitted at once, further callers wait for a
+free worker, so work does not pile up in the pool queue.
+
+Workers are started by a forkserver, not forked from the app, whose threads
+(trio's, psycopg2's) may hold locks at the time. When a worker dies, e.g.
+killed for using too much memory, the pool is replaced, and what it was
+running tried once more.
+
+Workers import this module, not artifacts.py: the store (its directory scan
+and eviction) only lives in the app processes, workers just open archives.
+"""
+import logging
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from os import environ
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+from zipfile import ZipFile
+
+import trio
+
+from .reports import CompItem, compact_member, is_report
+
+log = logging.getLogger(__name__)
+
+PARSE_WORKERS = int(environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+
+T = TypeVar("T")
+
+
+class Map(mmap.mmap):
+    # ZipFile wants a seekable file, mmap only says so itself from python 3.13.
+    def seekable(self) -> bool:
+        return True
+
+
+@contextmanager
+def open_archive(path: Path) -> Iterator[ZipFile]:
+    """
+    ZipFile reading the archive through a read only map.
+    """
+    with open(path, "rb") as f, Map(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with ZipFile(mm) as z:
+            yield z
+
+
+def list_members(path: Path) -> List[str]:
+    with open_archive(path) as z:
+        return [
+            info.filename
+            for info in z.infolist()
+            if not info.is_dir() and is_report(info.filename)
+        ]
+
+
+def compact_archive_member(path: Path, member: str) -> List[CompItem]:
+    with open_archive(path) as z:
+        return compact_member(z, z.getinfo(member))
+
+
+class ParsePool:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._limiter = trio.CapacityLimiter(workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run ``func(*args)`` in a worker process, waiting for a free one first.
+        """
+        async with self._limiter:
+            try:
+                return await self._submit(func, *args)
+            except BrokenProcessPool:
+                log.exception("A parse worker died, retrying in a new pool")
+                return await self._submit(func, *args)
+
+    async def _submit(self, func: Callable[..., T], *args: Any) -> T:
+        if self._executor is None:
+            log.info("Starting %s parse workers", self.workers)
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+        executor = self._executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._broken(executor)
+            raise
+        done = trio.Event()
+        token = trio.lowlevel.current_trio_token()
+        future.add_done_callback(lambda _: token.run_sync_soon(done.set))
+        try:
+            await done.wait()
+        except BaseException:
+            future.cancel()
+            raise
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._broken(executor)
+            raise
+
+    def _broken(self, executor: ProcessPoolExecutor) -> None:
+        # other callers see the same pool break, only replace it once.
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.workers,
+            "busy": self._limiter.borrowed_tokens,
+            "waiting": self._limiter.statistics().tasks_waiting,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+PARSER = ParsePool(PARSE_WORKERS)
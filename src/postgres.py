@@ -1,24 +1,151 @@
 import psycopg2
-from contextlib import contextmanager
+import threading
+import trio
+from contextlib import asynccontextmanager, contextmanager
+from hashlib import blake2b
 from os import environ
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Callable, Optional
 import logging
 
 log = logging.getLogger("postgres")
 
-@contextmanager
-def db_get_cursor():
-    conn = psycopg2.connect(
+# maximum number of connections open to postgres, and so of queries running at
+# the same time.
+POOL_SIZE = int(environ.get("POSTGRES_POOL_SIZE", 10))
+
+# seconds between attempts to take an advisory lock held by someone else.
+LOCK_POLL_INTERVAL = 0.5
+
+_pool = None
+# get_pool is called from the worker threads of db_run.
+_pool_lock = threading.Lock()
+_limiter = None
+
+
+def _params():
+    return dict(
         host=environ["POSTGRES_HOST"],
         user=environ["POSTGRES_USER"],
         password=environ["POSTGRES_PASSWORD"],
         dbname=environ["POSTGRES_DB"],
-        port=environ["POSTGRES_PORT"]
+        port=environ["POSTGRES_PORT"],
     )
+
+
+def get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(1, POOL_SIZE, **_params())
+    return _pool
+
+
+@contextmanager
+def db_get_cursor():
+    """
+    Blocking, borrow a connection from the pool for the duration of the block.
+
+    From async code use db_run instead.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
     cursor = conn.cursor()
     try:
         yield cursor
         conn.commit()
     except psycopg2.DatabaseError as err:
         log.exception("Error in cursor: %s", err.args)
+        if not conn.closed:
+            conn.rollback()
     finally:
-        conn.close()
+        cursor.close()
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+async def db_run(func, *args):
+    """
+    Run ``func(cursor, *args)`` in a worker thread with a pooled cursor, and
+    return its result.
+
+    At most POOL_SIZE of those run at the same time, so we never wait on the pool
+    itself in a thread. Like db_get_cursor, database errors are logged and
+    swallowed, in which case the result is None.
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = trio.CapacityLimiter(POOL_SIZE)
+
+    def run():
+        with db_get_cursor() as cursor:
+            return func(cursor, *args)
+
+    return await trio.to_thread.run_sync(run, limiter=_limiter)
+
+
+class AdvisoryLocks:
+    """
+    Postgres advisory locks, to coordinate work between processes (and
+    replicas) sharing the database.
+
+    The locks of a process are all held by one dedicated connection rather than
+    pooled ones, so that holding them for the duration of an ingestion does not
+    take connections away from queries. Postgres lets a connection take the
+    same lock twice, so within a process it is SingleFlight that keeps tasks
+    apart.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _execute(self, query: str, key: int) -> bool:
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(**_params())
+                self._conn.autocommit = True
+            with self._conn.cursor() as cursor:
+                cursor.execute(query, (key,))
+                return cursor.fetchone()[0]
+
+    @asynccontextmanager
+    async def hold(self, name: str, waiting: Optional[Callable[[], None]] = None):
+        """
+        Hold the lock called ``name`` for the duration of the block, calling
+        ``waiting()`` first if someone else has it. Yields whether we waited.
+
+        If postgres can not be reached, the block runs without the lock.
+        """
+        digest = blake2b(name.encode(), digest_size=8).digest()
+        key = int.from_bytes(digest, "big", signed=True)
+        locked = waited = False
+        try:
+            while not await trio.to_thread.run_sync(
+                self._execute, "SELECT pg_try_advisory_lock(%s)", key
+            ):
+                if waiting is not None and not waited:
+                    waiting()
+                waited = True
+                await trio.sleep(LOCK_POLL_INTERVAL)
+            locked = True
+        except psycopg2.Error as err:
+            log.warning("Running %s without lock: %s", name, err)
+        try:
+            yield waited
+        finally:
+            if locked:
+                with trio.CancelScope(shield=True):
+                    await self._unlock(name, key)
+
+    async def _unlock(self, name: str, key: int) -> None:
+        try:
+            await trio.to_thread.run_sync(
+                self._execute, "SELECT pg_advisory_unlock(%s)", key
+            )
+        except psycopg2.Error:
+            # released with the connection anyway.
+            log.exception("Could not release lock %s", name)
+
+
+LOCKS = AdvisoryLocks()
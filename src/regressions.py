@@ -0,0 +1,119 @@
+"""
+Duration regressions of a PR against its base branch.
+
+The baseline of a branch is, for each (matrix file, nodeid), the mean and
+standard deviation of its setup+call+teardown duration over the most recent
+completed runs of the branch. It is precomputed in postgres when those runs
+are ingested (see ``store.put_baseline``), so comparing a PR only needs to
+look up all of its rows in the baseline, which is done with a sorted array of
+keys and ``searchsorted`` rather than per row.
+
+CI timings are noisy, so a row is only flagged as a regression when it is
+slower than the baseline by at least MIN_DELTA seconds and MIN_RATIO times,
+and by more than Z_THRESHOLD standard deviations, the standard deviation being
+at least NOISE of the mean so that tests with very stable baselines are not
+flagged for tiny changes.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from .aggregate import Frame
+
+MIN_RUNS = 3
+MIN_DELTA = 0.05
+MIN_RATIO = 1.2
+Z_THRESHOLD = 3.0
+NOISE = 0.1
+
+
+@dataclass
+class Baseline:
+    files: Dict[str, int]  # matrix file -> index
+    nodeids: Dict[str, int]  # nodeid -> index
+    key: np.ndarray  # sorted, node index * len(files) + file index
+    n: np.ndarray  # number of runs, per key
+    mean: np.ndarray
+    std: np.ndarray
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[str, str, int, float, float]]) -> "Baseline":
+        files: Dict[str, int] = {}
+        nodeids: Dict[str, int] = {}
+        for member, _, _, _, _ in rows:
+            files.setdefault(member, len(files))
+        key = np.fromiter(
+            (
+                nodeids.setdefault(nodeid, len(nodeids)) * len(files) + files[member]
+                for member, nodeid, _, _, _ in rows
+            ),
+            dtype=np.int64,
+            count=len(rows),
+        )
+        values = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, 3)
+        order = np.argsort(key)
+        return cls(
+            files,
+            nodeids,
+            key[order],
+            values[order, 0],
+            values[order, 1],
+            values[order, 2],
+        )
+
+
+def compare(frame: Frame, baseline: Baseline, top: int = 50) -> Dict[str, Any]:
+    """
+    Compare each row of the PR with the baseline of the same nodeid in the same
+    matrix file, and return the ``top`` regressions, largest slowdown first.
+    """
+    file = np.array([baseline.files.get(f, -1) for f in frame.files], dtype=np.int64)
+    node = np.fromiter(
+        (baseline.nodeids.get(n, -1) for n in frame.nodeids),
+        dtype=np.int64,
+        count=len(frame.nodeids),
+    )
+    file, node = file[frame.file], node[frame.node]
+    key = node * len(baseline.files) + file
+    pos = np.searchsorted(baseline.key, key)
+    found = (file >= 0) & (node >= 0) & (pos < len(baseline.key))
+    found[found] = baseline.key[pos[found]] == key[found]
+
+    rows, pos = np.flatnonzero(found), pos[found]
+    total = frame.durations[rows].sum(axis=1)
+    n, mean = baseline.n[pos], baseline.mean[pos]
+    std = np.maximum(baseline.std[pos], NOISE * mean)
+    delta = total - mean
+    ratio = total / np.maximum(mean, 1e-6)
+    z = delta / np.maximum(std, 1e-6)
+    flagged = (
+        (n >= MIN_RUNS)
+        & (delta >= MIN_DELTA)
+        & (ratio >= MIN_RATIO)
+        & (z >= Z_THRESHOLD)
+    )
+
+    order = np.flatnonzero(flagged)
+    order = order[np.argsort(-delta[order], kind="stable")][:top]
+    return {
+        "n_rows": len(frame.node),
+        "n_compared": len(rows),
+        "n_regressions": int(flagged.sum()),
+        "duration": float(total.sum()),
+        "baseline_duration": float(mean.sum()),
+        "regressions": [
+            {
+                "nodeid": frame.nodeids[frame.node[rows[i]]],
+                "file": frame.files[frame.file[rows[i]]],
+                "duration": float(total[i]),
+                "baseline": float(mean[i]),
+                "std": float(baseline.std[pos[i]]),
+                "runs": int(n[i]),
+                "delta": float(delta[i]),
+                "ratio": float(ratio[i]),
+                "z": float(z[i]),
+            }
+            for i in order
+        ],
+    }
@@ -0,0 +1,273 @@
+"""
+Download only the reports out of an artifact archive, with range requests.
+
+Artifacts often bundle much larger files next to the reports (coverage data,
+logs, wheels, ...). The central directory at the end of a zip says where each
+member is, so we fetch the end of the archive first, then only the byte ranges
+of the members that look like reports (see ``is_report``), and write them out
+as a smaller but valid archive: their local headers and compressed data are
+copied as is, followed by a new central directory with the offsets they now
+have. The rest of the pipeline reads it like any other archive.
+
+Servers that ignore ``Range`` answer the first request with the whole archive,
+which is then used as is. Archives we can't read that way (ZIP64, split,
+prefixed by a stub, a range refused halfway, ...) are downloaded again in full,
+over what was written of them.
+"""
+import logging
+import struct
+from bisect import bisect_right
+from dataclasses import dataclass
+from os import environ
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+import trio
+
+from .client import CLIENT, DOWNLOAD_CHUNK_SIZE
+from .metrics import Counter
+from .reports import is_report
+
+log = logging.getLogger(__name__)
+
+# archives smaller than this, in bytes, are downloaded in one request.
+RANGE_MIN_BYTES = int(environ.get("ARTIFACT_RANGE_MIN_BYTES", 1024**2))
+
+# end of central directory record, without its comment, and central directory
+# file header, without name, extra field and comment, as in zipfile.
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+_ZIP64_LOCATOR_SIZE = 20
+_CENTRAL = struct.Struct("<4s4B4HL2L5H2L")
+_CENTRAL_SIGNATURE = b"PK\x01\x02"
+# offset of the local header offset in a central directory record.
+_OFFSET_FIELD = 42
+# the end of central directory record, with the longest comment it can have.
+TAIL_SIZE = _EOCD.size + 0xFFFF
+# rather download this many bytes we don't need than make another request.
+MERGE_GAP = 64 * 1024
+
+DOWNLOADS = Counter(
+    "ptv_archive_downloads_total",
+    "Artifact archives downloaded, by mode: reports only or full.",
+    ["mode"],
+)
+SKIPPED_BYTES = Counter(
+    "ptv_skipped_bytes_total",
+    "Bytes of artifact archives not downloaded, since they are not reports.",
+)
+
+
+class Unsupported(Exception):
+    """
+    The archive can't be downloaded by ranges, get all of it instead.
+    """
+
+
+@dataclass
+class Member:
+    name: str
+    # central directory record, with name, extra field and comment.
+    record: bytes
+    # offset of the local header
+    start: int
+    # offset of what follows the member's data, and data descriptor if any.
+    end: int = 0
+
+
+def parse_tail(tail: bytes, size: int) -> Tuple[int, int, int]:
+    """
+    ``(entries, offset, size)`` of the central directory, from the last bytes
+    of an archive of ``size`` bytes.
+    """
+    at = tail.rfind(_EOCD_SIGNATURE)
+    while at >= 0:
+        fields = _EOCD.unpack_from(tail, at)
+        # the signature could also be part of the comment.
+        if at + _EOCD.size + fields[-1] == len(tail):
+            break
+        at = tail.rfind(_EOCD_SIGNATURE, 0, at)
+    if at < 0:
+        raise Unsupported("no end of central directory")
+    _, disk, cd_disk, disk_entries, entries, cd_size, cd_offset, _ = fields
+    locator = at - _ZIP64_LOCATOR_SIZE
+    if locator >= 0 and tail[locator : locator + 4] == _ZIP64_LOCATOR_SIGNATURE:
+        raise Unsupported("ZIP64")
+    if disk or cd_disk or disk_entries != entries:
+        raise Unsupported("split archive")
+    if cd_offset + cd_size != size - len(tail) + at:
+        raise Unsupported("offsets don't start at the beginning of the file")
+    return entries, cd_offset, cd_size
+
+
+def parse_central_directory(data: bytes, entries: int, end: int) -> List[Member]:
+    """
+    Members of the archive whose central directory is ``data``, and starts at
+    ``end``, in the order it lists them.
+    """
+    members = []
+    at = 0
+    for _ in range(entries):
+        if data[at : at + 4] != _CENTRAL_SIGNATURE:
+            raise Unsupported("bad central directory")
+        fields = _CENTRAL.unpack_from(data, at)
+        flags, compress_size, file_size = fields[5], fields[10], fields[11]
+        name_length, extra_length, comment_length = fields[12:15]
+        start = fields[18]
+        if 0xFFFFFFFF in (compress_size, file_size, start):
+            raise Unsupported("ZIP64")
+        name = data[at + _CENTRAL.size : at + _CENTRAL.size + name_length]
+        length = _CENTRAL.size + name_length + extra_length + comment_length
+        members.append(
+            Member(
+                name.decode("utf-8" if flags & 0x800 else "cp437"),
+                data[at : at + length],
+                start,
+            )
+        )
+        at += length
+    # the local header is followed by the data, and a data descriptor of
+    # variable size, so each member goes on up to the next one.
+    bounds = sorted({m.start for m in members} | {end})
+    for m in members:
+        if m.start >= end:
+            raise Unsupported("member after the central directory")
+        m.end = bounds[bisect_right(bounds, m.start)]
+    return members
+
+
+def _central_directory(members: List[Tuple[Member, int]]) -> bytes:
+    """
+    Central directory of an archive holding ``members`` at the given offsets.
+    """
+    records = bytearray()
+    for member, offset in members:
+        record = bytearray(member.record)
+        struct.pack_into("<L", record, _OFFSET_FIELD, offset)
+        records += record
+    return bytes(records)
+
+
+def _end_of_central_directory(entries: int, cd_offset: int, cd_size: int) -> bytes:
+    return _EOCD.pack(_EOCD_SIGNATURE, 0, 0, entries, entries, cd_size, cd_offset, 0)
+
+
+class _Remote:
+    """
+    An archive read by ranges, the end of which we already have.
+    """
+
+    def __init__(self, url: str, headers: Dict[str, str], tail: bytes, size: int):
+        self.url = url
+        self.headers = headers
+        self.tail = tail
+        self.size = size
+        self.transferred = len(tail)
+
+    async def read(self, start: int, end: int, write: Callable[[bytes], None]):
+        """
+        Pass the bytes from ``start`` to ``end`` of the archive to ``write``,
+        called in a thread.
+        """
+        tail_start = self.size - len(self.tail)
+        if start >= tail_start:
+            await trio.to_thread.run_sync(
+                write, self.tail[start - tail_start : end - tail_start]
+            )
+            return
+        headers = {**self.headers, "Range": f"bytes={start}-{end - 1}"}
+        async with CLIENT.stream(self.url, headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise Unsupported(f"range not honoured ({resp.status_code})")
+            async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                self.transferred += len(chunk)
+                await trio.to_thread.run_sync(write, chunk)
+
+    async def members(self) -> List[Member]:
+        entries, cd_offset, cd_size = parse_tail(self.tail, self.size)
+        data = bytearray()
+        await self.read(cd_offset, cd_offset + cd_size, data.extend)
+        return parse_central_directory(bytes(data), entries, cd_offset)
+
+
+async def _copy_reports(
+    remote: _Remote, members: List[Member], write: Callable[[bytes], None]
+) -> None:
+    """
+    Write an archive of the ``members`` that are reports, see module docstring.
+    """
+    reports = sorted(
+        (m for m in members if is_report(m.name) and not m.name.endswith("/")),
+        key=lambda m: m.start,
+    )
+    # members close to each other are fetched with the same request, what is
+    # in between is copied too, but not part of the new central directory.
+    runs: List[List[Member]] = []
+    for member in reports:
+        if runs and member.start - runs[-1][-1].end <= MERGE_GAP:
+            runs[-1].append(member)
+        else:
+            runs.append([member])
+    copied: List[Tuple[Member, int]] = []
+    offset = 0
+    for run in runs:
+        await remote.read(run[0].start, run[-1].end, write)
+        for member in run:
+            copied.append((member, offset + member.start - run[0].start))
+        offset += run[-1].end - run[0].start
+    directory = _central_directory(copied)
+    end = _end_of_central_directory(len(copied), offset, len(directory))
+    await trio.to_thread.run_sync(write, directory + end)
+
+
+async def download_reports(
+    url: str,
+    write: Callable[[bytes], None],
+    reset: Callable[[], None],
+    size: int,
+    headers: Dict[str, str],
+) -> None:
+    """
+    Like ``CLIENT.download``, but for an archive of about ``size`` bytes, of
+    which only the reports are written, see the module docstring. ``reset``
+    (called in a thread) discards what was written, before the archive is
+    downloaded in full after all.
+    """
+    if size < RANGE_MIN_BYTES:
+        DOWNLOADS.inc(mode="full")
+        await CLIENT.download(url, write, headers=headers)
+        return
+    tail_headers = {**headers, "Range": f"bytes=-{TAIL_SIZE}"}
+    async with CLIENT.stream(url, headers=tail_headers) as resp:
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            log.info("No range requests for %s, downloading all of it", url)
+            DOWNLOADS.inc(mode="full")
+            async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                await trio.to_thread.run_sync(write, chunk)
+            return
+        tail = await resp.aread()
+        total = resp.headers.get("content-range", "").rpartition("/")[2]
+        # the archive itself is often served by another host, to which we
+        # were redirected, and which must not get our token.
+        location = str(resp.url)
+    same_host = urlsplit(location).netloc == urlsplit(url).netloc
+    try:
+        if not total.isdigit():
+            raise Unsupported(f"unknown size {total!r}")
+        remote = _Remote(location, headers if same_host else {}, tail, int(total))
+        members = await remote.members()
+        await _copy_reports(remote, members, write)
+    except Unsupported as e:
+        log.info("Can't read %s by ranges (%s), downloading all of it", url, e)
+        DOWNLOADS.inc(mode="full")
+        await trio.to_thread.run_sync(reset)
+        await CLIENT.download(url, write, headers=headers)
+        return
+    DOWNLOADS.inc(mode="reports")
+    SKIPPED_BYTES.inc(max(0, remote.size - remote.transferred))
+    log.info(
+        "Downloaded %s of the %s bytes of %s", remote.transferred, remote.size, url
+    )
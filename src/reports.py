@@ -0,0 +1,72 @@
+"""
+Compaction of pytest-json-report files.
+
+The viewer only needs the nodeid and the setup/call/teardown durations of each
+test, everything else in the report is dropped.
+
+Reports of large test suites, with captured logs, can be hundreds of MB, so
+members of artifacts are parsed incrementally with ijson and never fully
+loaded in memory.
+"""
+import logging
+from typing import IO, Any, Dict, List, Tuple
+from zipfile import ZipFile, ZipInfo
+
+import ijson
+
+log = logging.getLogger(__name__)
+
+CompItem = Tuple[str, float, float, float]
+
+
+def is_report(name: str) -> bool:
+    """
+    Whether the archive member ``name`` looks like a report, artifacts may hold
+    other files (coverage data, logs, ...) which we don't look at.
+    """
+    return name.lower().endswith(".json")
+
+
+def _compact_item(item: Dict[str, Any], comp_test: List[CompItem]) -> None:
+    if "outcome" in item and item["outcome"] == "skipped":
+        return
+    if "call" in item:
+        comp_test.append(
+            (item["nodeid"], item["call"], item["setup"], item["teardown"])
+        )
+    else:
+        log.warning("unhandled item %r", item)
+
+
+# ijson prefix of the values we keep -> key in the item
+_FIELDS = {
+    "tests.item.nodeid": "nodeid",
+    "tests.item.outcome": "outcome",
+    "tests.item.setup.duration": "setup",
+    "tests.item.call.duration": "call",
+    "tests.item.teardown.duration": "teardown",
+}
+
+
+def compact_stream(fp: IO[bytes]) -> List[CompItem]:
+    """
+    The ``comp`` table of a report, ``(nodeid, call, setup, teardown)`` for
+    each test that was not skipped, reading it from a binary file object.
+
+    Only the fields we keep are ever materialised, so memory is bounded by the
+    size of the ``comp`` table, not the size of the report.
+    """
+    comp_test: List[CompItem] = []
+    item: Dict[str, Any] = {}
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if prefix in _FIELDS:
+            item[_FIELDS[prefix]] = value
+        elif prefix == "tests.item" and event == "end_map":
+            _compact_item(item, comp_test)
+            item = {}
+    return comp_test
+
+
+def compact_member(z: ZipFile, member: ZipInfo) -> List[CompItem]:
+    with z.open(member) as fp:
+        return compact_stream(fp)
@@ -0,0 +1,87 @@
+"""
+Single-flight coalescing of concurrent work.
+
+When a PR link is shared, many viewers open it at the same time. Only the first
+one starts the work, as a background task, every viewer (including the first)
+subscribes to the messages it publishes. Late subscribers get the messages
+published so far replayed before the new ones, so they are all kept until the
+work is done: publish small messages, e.g. ids rather than results.
+"""
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+import trio
+
+log = logging.getLogger(__name__)
+
+
+class Flight:
+    """
+    Messages published by one unit of work.
+    """
+
+    def __init__(self):
+        self.messages: List[Tuple[Any, ...]] = []
+        self.done = False
+        self._changed = trio.Event()
+
+    def _wake(self) -> None:
+        changed, self._changed = self._changed, trio.Event()
+        changed.set()
+
+    def publish(self, *message: Any) -> None:
+        self.messages.append(message)
+        self._wake()
+
+    def close(self) -> None:
+        self.done = True
+        self._wake()
+
+    async def subscribe(self):
+        """
+        Iterate over all the messages, from the first one, until the work is done.
+        """
+        i = 0
+        while True:
+            while i < len(self.messages):
+                yield self.messages[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def join(
+        self,
+        key: Hashable,
+        nursery: trio.Nursery,
+        func: Callable[..., Awaitable[None]],
+        *args: Any,
+    ) -> Flight:
+        """
+        Return the flight for ``key``, starting ``func(*args, publish)`` in
+        ``nursery`` if there is none in progress.
+
+        ``func`` must not raise, failures should be published.
+        """
+        if key in self._flights:
+            log.info("Joining flight in progress for %s", key)
+            return self._flights[key]
+        flight = self._flights[key] = Flight()
+
+        async def run():
+            try:
+                await func(*args, flight.publish)
+            finally:
+                del self._flights[key]
+                flight.close()
+
+        nursery.start_soon(run)
+        return flight
@@ -0,0 +1,455 @@
+"""
+Derived-result cache.
+
+A finished artifact never changes, so once one of its reports has been
+compacted we keep the ``comp`` table in postgres, keyed by artifact id and zip
+member. Tables are stored and returned as JSON text so that they can be sent
+to the client without being parsed again. Artifacts are also recorded as
+processed, since some have no reports, and so no tables.
+
+We also record, per head sha, which artifacts make up the data of a PR once
+all the workflow runs for this sha are completed; repeat views then only need
+the PR lookup.
+
+Besides this cache, which is what views are served from, each row is also
+ingested into normalized tables (interned nodeids, one ``test_result`` row per
+test and report file) to be queried across runs. Ingestion goes through a
+single ``COPY`` into a staging table. From those, we precompute per branch
+baselines of each test, that PRs are compared with (see regressions.py).
+
+Reports can also be uploaded by the CI job itself (see ``put_upload``), they
+then stand in for the artifacts of their run.
+
+Listings (pulls, action runs) are paginated by keyset, most recent first, see
+``list_page``.
+"""
+import csv
+import io
+import json
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from .github_types import Artifact, ArtifactWorkflowRun, CommitSha
+from .postgres import db_run
+from .reports import CompItem
+
+log = logging.getLogger(__name__)
+
+
+async def get_report_tables(artifact_ids: List[int]) -> Optional[Dict[str, str]]:
+    """
+    Return ``{member: comp_json}`` for all the given artifacts, or None if any of
+    them has not been parsed yet.
+    """
+    if not artifact_ids:
+        return {}
+
+    def get(cursor):
+        cursor.execute(
+            "SELECT count(*) FROM processed_artifact WHERE artifact_id = ANY(%s)",
+            (list(set(artifact_ids)),),
+        )
+        if cursor.fetchone()[0] != len(set(artifact_ids)):
+            return None
+        cursor.execute(
+            """
+            SELECT artifact_id, member, comp::text FROM report_table
+            WHERE artifact_id = ANY(%s)
+            ORDER BY artifact_id, member
+            """,
+            (list(artifact_ids),),
+        )
+        return {member: comp for _, member, comp in cursor.fetchall()}
+
+    return await db_run(get)
+
+
+async def put_report_tables(artifact_id: int, tables: Dict[str, str]) -> None:
+    """
+    Store the tables of an artifact, and mark it as processed, even if it has
+    no tables at all.
+    """
+
+    await db_run(_insert_tables, artifact_id, tables)
+
+
+def _insert_tables(cursor, artifact_id: int, tables: Dict[str, str]) -> None:
+    if tables:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO report_table (artifact_id, member, comp)
+            VALUES %s
+            ON CONFLICT (artifact_id, member) DO NOTHING
+            """,
+            [(artifact_id, member, comp) for member, comp in tables.items()],
+        )
+    cursor.execute(
+        """
+        INSERT INTO processed_artifact (artifact_id) VALUES (%s)
+        ON CONFLICT (artifact_id) DO NOTHING
+        """,
+        (artifact_id,),
+    )
+
+
+async def get_head_summary(org: str, repo: str, sha: CommitSha) -> Optional[List[int]]:
+    """
+    Return the ids of the artifacts for this head sha, if we have seen all of
+    them already.
+    """
+
+    def get(cursor):
+        cursor.execute(
+            """
+            SELECT artifact_ids FROM head_summary
+            WHERE organization = %s AND repo = %s AND head_sha = %s
+            """,
+            (org, repo, sha),
+        )
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    return await db_run(get)
+
+
+async def put_head_summary(
+    org: str, repo: str, sha: CommitSha, artifact_ids: List[int]
+) -> None:
+    def put(cursor):
+        cursor.execute(
+            """
+            INSERT INTO head_summary
+                (organization, repo, head_sha, artifact_ids, n_tests)
+            SELECT
+                %(org)s, %(repo)s, %(sha)s, %(ids)s,
+                COALESCE(SUM(json_array_length(comp)), 0)
+            FROM report_table WHERE artifact_id = ANY(%(ids)s)
+            ON CONFLICT (organization, repo, head_sha) DO UPDATE
+            SET artifact_ids = EXCLUDED.artifact_ids, n_tests = EXCLUDED.n_tests
+            """,
+            {"org": org, "repo": repo, "sha": sha, "ids": list(artifact_ids)},
+        )
+
+    await db_run(put)
+
+
+async def ingest_test_results(
+    org: str, repo: str, artifact: Artifact, comps: Dict[str, List[CompItem]]
+) -> None:
+    """
+    Bulk load the rows of all the report files of an artifact in the normalized
+    tables. Report files that were already ingested are skipped.
+    """
+    run = artifact.workflow_run
+
+    def ingest(cursor):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for member, comp in comps.items():
+            writer.writerows((member, *item) for item in comp)
+        buffer.seek(0)
+
+        cursor.execute("""
+            CREATE TEMP TABLE staging (
+                member TEXT, nodeid TEXT, call REAL, setup REAL, teardown REAL,
+                hash UUID GENERATED ALWAYS AS (md5(nodeid)::uuid) STORED
+            ) ON COMMIT DROP
+            """)
+        cursor.copy_expert(
+            """
+            COPY staging (member, nodeid, call, setup, teardown)
+            FROM STDIN WITH (FORMAT csv)
+            """,
+            buffer,
+        )
+        cursor.execute("""
+            INSERT INTO nodeid (hash, nodeid)
+            SELECT DISTINCT ON (s.hash) s.hash, s.nodeid FROM staging s
+            WHERE NOT EXISTS (SELECT 1 FROM nodeid n WHERE n.hash = s.hash)
+            ON CONFLICT (hash) DO NOTHING
+            """)
+        cursor.execute(
+            """
+            WITH new_files AS (
+                INSERT INTO report_file (
+                    organization, repo, run_id, head_branch, head_sha,
+                    artifact_id, member
+                )
+                SELECT DISTINCT %s, %s, %s, %s, %s, %s, member FROM staging
+                ON CONFLICT (artifact_id, member) DO NOTHING
+                RETURNING id, member
+            )
+            INSERT INTO test_result (report_file_id, nodeid_id, call, setup, teardown)
+            SELECT f.id, n.id, s.call, s.setup, s.teardown
+            FROM staging s
+            JOIN new_files f USING (member)
+            JOIN nodeid n USING (hash)
+            """,
+            (org, repo, run.id, run.head_branch, run.head_sha, artifact.id),
+        )
+        return cursor.rowcount
+
+    if comps:
+        n = await db_run(ingest)
+        log.info("Ingested %s test results for artifact %s", n, artifact.id)
+
+
+async def get_baseline_state(
+    org: str, repo: str, branch: str
+) -> Optional[Tuple[List[int], float]]:
+    """
+    Run ids the baseline of this branch was computed from, and its age in
+    seconds, or None if there is none yet.
+    """
+
+    def get(cursor):
+        cursor.execute(
+            """
+            SELECT run_ids, EXTRACT(EPOCH FROM now() - computed_at)
+            FROM baseline_state
+            WHERE organization = %s AND repo = %s AND branch = %s
+            """,
+            (org, repo, branch),
+        )
+        row = cursor.fetchone()
+        return None if row is None else (row[0], float(row[1]))
+
+    return await db_run(get)
+
+
+async def get_baseline(
+    org: str, repo: str, branch: str
+) -> List[Tuple[str, str, int, float, float]]:
+    """
+    ``(member, nodeid, n, mean, std)`` rows of the baseline of this branch.
+    """
+
+    def get(cursor):
+        cursor.execute(
+            """
+            SELECT b.member, n.nodeid, b.n, b.mean, b.std
+            FROM baseline b JOIN nodeid n ON n.id = b.nodeid_id
+            WHERE b.organization = %s AND b.repo = %s AND b.branch = %s
+            """,
+            (org, repo, branch),
+        )
+        return cursor.fetchall()
+
+    return await db_run(get) or []
+
+
+async def put_baseline(org: str, repo: str, branch: str, run_ids: List[int]) -> None:
+    """
+    Recompute the baseline of this branch from the already ingested results of
+    the given runs.
+    """
+    params = {"org": org, "repo": repo, "branch": branch, "run_ids": list(run_ids)}
+
+    def put(cursor):
+        cursor.execute(
+            """
+            DELETE FROM baseline
+            WHERE organization = %(org)s AND repo = %(repo)s AND branch = %(branch)s
+            """,
+            params,
+        )
+        cursor.execute(
+            """
+            INSERT INTO baseline
+                (organization, repo, branch, member, nodeid_id, n, mean, std)
+            SELECT
+                %(org)s, %(repo)s, %(branch)s, f.member, t.nodeid_id, count(*),
+                avg(t.call + t.setup + t.teardown),
+                COALESCE(stddev_samp(t.call + t.setup + t.teardown), 0)
+            FROM report_file f JOIN test_result t ON t.report_file_id = f.id
+            WHERE f.run_id = ANY(%(run_ids)s)
+                AND f.organization = %(org)s AND f.repo = %(repo)s
+            GROUP BY f.member, t.nodeid_id
+            """,
+            params,
+        )
+        n = cursor.rowcount
+        cursor.execute(
+            """
+            INSERT INTO baseline_state (organization, repo, branch, run_ids)
+            VALUES (%(org)s, %(repo)s, %(branch)s, %(run_ids)s)
+            ON CONFLICT (organization, repo, branch) DO UPDATE
+            SET run_ids = EXCLUDED.run_ids, computed_at = now()
+            """,
+            params,
+        )
+        return n
+
+    n = await db_run(put)
+    log.info("Baseline of %s/%s %s: %s rows", org, repo, branch, n)
+
+
+def _upload_artifact(upload_id: int, name: str, run: ArtifactWorkflowRun) -> Artifact:
+    # negated, see migrations/*_uploads
+    return Artifact(-upload_id, name, 0, "", run)
+
+
+async def put_upload(
+    org: str,
+    repo: str,
+    run: ArtifactWorkflowRun,
+    attempt: int,
+    name: str,
+    tables: Dict[str, str],
+) -> Optional[Artifact]:
+    """
+    Record an upload of reports for an attempt of ``run`` along with its
+    tables, in the same transaction so that an upload is never listed without
+    them, and return the artifact they are stored as. Uploading again under
+    the same name in the same attempt replaces the tables of that artifact.
+    """
+
+    def put(cursor):
+        cursor.execute(
+            """
+            INSERT INTO report_upload
+                (organization, repo, run_id, run_attempt, head_branch, head_sha, name)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (organization, repo, run_id, run_attempt, name) DO UPDATE
+            SET uploaded_at = now()
+            RETURNING id
+            """,
+            (org, repo, run.id, attempt, run.head_branch, run.head_sha, name),
+        )
+        upload_id = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM report_table WHERE artifact_id = %s", (-upload_id,))
+        _insert_tables(cursor, -upload_id, tables)
+        return upload_id
+
+    upload_id = await db_run(put)
+    return None if upload_id is None else _upload_artifact(upload_id, name, run)
+
+
+async def get_uploads(org: str, repo: str, run_ids: List[int]) -> List[Artifact]:
+    """
+    Uploads for any of these runs, in place of their artifacts. Only those of
+    the last attempt of each run that uploaded.
+    """
+
+    def get(cursor):
+        cursor.execute(
+            """
+            SELECT id, name, run_id, head_branch, head_sha FROM report_upload u
+            WHERE organization = %s AND repo = %s AND run_id = ANY(%s)
+            AND run_attempt = (
+                SELECT max(run_attempt) FROM report_upload l
+                WHERE l.organization = u.organization AND l.repo = u.repo
+                AND l.run_id = u.run_id
+            )
+            ORDER BY id
+            """,
+            (org, repo, list(run_ids)),
+        )
+        return cursor.fetchall()
+
+    return [
+        _upload_artifact(upload_id, name, ArtifactWorkflowRun(run_id, branch, sha))
+        for upload_id, name, run_id, branch, sha in await db_run(get) or []
+    ]
+
+
+# sort columns of the listings, most significant first, see migrations/*_listing
+PULL_ORDER = ["last_seen_at", "organization", "repo", "pull_number"]
+ACTION_RUN_ORDER = ["seen_at", "organization", "repo", "run_id", "pull_number"]
+
+
+def encode_cursor(row: Dict[str, Any], order: List[str]) -> str:
+    values = [
+        v.isoformat() if isinstance(v, datetime) else v for v in map(row.get, order)
+    ]
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+# integer sort columns, and their bound, the other ones are text or timestamps.
+_INT_COLUMNS = {"run_id": 2**63, "pull_number": 2**31}
+
+
+def _cursor_value(column: str, value: Any) -> Any:
+    if column.endswith("_at"):
+        return datetime.fromisoformat(value)
+    if column in _INT_COLUMNS:
+        if type(value) is not int or abs(value) >= _INT_COLUMNS[column]:
+            raise TypeError(f"Invalid {column} {value!r}")
+    elif not isinstance(value, str):
+        raise TypeError(f"Invalid {column} {value!r}")
+    return value
+
+
+def decode_cursor(cursor: str, order: List[str]) -> List[Any]:
+    """
+    Raises ValueError or TypeError if ``cursor`` was not made by encode_cursor,
+    values of the wrong type included, so that they never reach the query.
+    """
+    values = json.loads(urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(order):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return [_cursor_value(column, value) for column, value in zip(order, values)]
+
+
+def keyset(
+    table: str,
+    order: List[str],
+    filters: Dict[str, Any],
+    after: Optional[List[Any]],
+    limit: int,
+) -> Tuple[str, List[Any]]:
+    """
+    Query for a page of ``table``: rows matching ``filters`` (column -> value),
+    sorted by the ``order`` columns descending, following the row with ``after``
+    as values of these columns.
+
+    Filtered columns are left out of the sort, so with an index on the filtered
+    columns followed by the remaining ones, a page is a single index range scan
+    however large the table.
+    """
+    sort = [c for c in order if c not in filters]
+    where = [f"{c} = %s" for c in filters]
+    args = list(filters.values())
+    if after is not None:
+        values = dict(zip(order, after))
+        where.append(f"({', '.join(sort)}) < ({', '.join(['%s'] * len(sort))})")
+        args.extend(values[c] for c in sort)
+    query = f"SELECT {', '.join(order)} FROM {table}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += f" ORDER BY {', '.join(c + ' DESC' for c in sort)} LIMIT %s"
+    return query, args + [limit]
+
+
+async def list_page(
+    table: str,
+    order: List[str],
+    filters: Dict[str, Any],
+    after: Optional[str],
+    limit: int,
+) -> Optional[Tuple[List[Dict[str, Any]], Optional[str]]]:
+    """
+    A page of ``table`` (see keyset), and the cursor of the next one if there
+    may be one, or None if the query failed.
+    """
+    query, args = keyset(
+        table,
+        order,
+        filters,
+        None if after is None else decode_cursor(after, order),
+        limit,
+    )
+
+    def select(cursor):
+        cursor.execute(query, args)
+        return [dict(zip(order, row)) for row in cursor.fetchall()]
+
+    rows = await db_run(select)
+    if rows is None:
+        return None
+    return rows, encode_cursor(rows[-1], order) if len(rows) == limit else None
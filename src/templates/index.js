@@ -76,6 +76,57 @@ function process_reply(raw, filename) {
   return data;
 }
 
+const COMPACT_KINDS = ['call', 'setup', 'teardown'];
+
+function process_compact(buffer) {
+  // decode the compact binary format (see wire.py) straight into the
+  // flattened items, each nodeid is only split once however many files it
+  // appears in.
+  const view = new DataView(buffer);
+  const decoder = new TextDecoder();
+  const magic = decoder.decode(new Uint8Array(buffer, 0, 4));
+  if (magic !== 'PTV1') {
+    throw new Error('Unknown compact format ' + magic);
+  }
+  const hlen = view.getUint32(4, true);
+  const header = JSON.parse(decoder.decode(new Uint8Array(buffer, 8, hlen)));
+  let offset = 8 + hlen + ((4 - (hlen % 4)) % 4);
+
+  const split = header.strings.map(function (nodeid) {
+    const [file, ...rest] = nodeid.split('::');
+    return [file, rest.join('::')];
+  });
+
+  let data = [];
+  for (const f of header.files) {
+    const n = f.n;
+    const ids = new Uint32Array(buffer, offset, n);
+    offset += 4 * n;
+    let columns = [];
+    for (let c = 0; c < COMPACT_KINDS.length; c++) {
+      columns.push(new Float32Array(buffer, offset, n));
+      offset += 4 * n;
+    }
+    for (let i = 0; i < n; i++) {
+      const [file, group] = split[ids[i]];
+      for (let c = 0; c < COMPACT_KINDS.length; c++) {
+        const value = columns[c][i] * 1000;
+        data.push({
+          key: file,
+          group: group,
+          kind: COMPACT_KINDS[c],
+          value: value,
+          duration: value,
+          outcome: 'passed',
+          name: f.name,
+        });
+      }
+    }
+    console.log('Treated ', n, 'items of', f.name);
+  }
+  return data;
+}
+
 //function dropHandler(ev) {
 //  // we let user drop file,
 //  // and will process them.
@@ -577,17 +628,88 @@ function start() {
     return;
   }
 
+  function add_data(items) {
+    // merge the files into what we already have, either all of them at once
+    // or one by one as they are streamed.
+    const first = window.DX === null;
+    window.DX = first ? items : window.DX.concat(items);
+    console.info(window.DX);
+    if (first) {
+      window.init();
+    } else {
+      // don't relayout on every single file.
+      debounced_init(250);
+    }
+  }
+
   function handle_test_data(dx) {
-    window.DX = [];
+    let items = [];
     for (const property in dx) {
       console.log(`${property}`, dx[property]);
-      window.DX = window.DX.concat(process_reply(dx[property], property));
+      items = items.concat(process_reply(dx[property], property));
+    }
+    add_data(items);
+  }
+
+  // compact tables still being fetched, and whether the stream is over.
+  let pending = 0;
+  let closed = false;
+
+  function maybe_done() {
+    if (closed && pending === 0 && window.DX !== null) {
+      remove_info();
+    }
+  }
+
+  async function handle_compact(url) {
+    pending += 1;
+    try {
+      const buffer = await (await fetch(url)).arrayBuffer();
+      add_data(process_compact(buffer));
+    } finally {
+      pending -= 1;
+      maybe_done();
     }
-    console.info(window.dx);
-    window.init();
   }
 
-  const eventSource = new EventSource('/api' + url.pathname);
+  async function show_regressions() {
+    // compared server side with the base branch, see regressions.py
+    const resp = await fetch('/api' + url.pathname + '/regressions');
+    if (resp.status !== 200) {
+      console.log('no regressions data', resp.status);
+      return;
+    }
+    const data = await resp.json();
+    if (data.regressions.length === 0) {
+      return;
+    }
+    document.getElementById('regressions-base').innerText = data.base;
+    const tbody = document.getElementById('regressions-rows');
+    for (const r of data.regressions) {
+      const row = tbody.insertRow();
+      for (const text of [
+        r.nodeid,
+        r.file,
+        timeformat(r.duration * 1000),
+        timeformat(r.baseline * 1000),
+        'x' + r.ratio.toFixed(1),
+      ]) {
+        row.insertCell().innerText = text;
+      }
+    }
+    document.getElementById('regressions').style.display = 'block';
+  }
+
+  function remove_info() {
+    const elem = document.getElementById('info');
+    if (elem) {
+      elem.parentNode.parentNode.removeChild(elem.parentNode);
+    }
+  }
+
+  const eventSource = new EventSource(
+    '/api' + url.pathname + '?mode=stream&format=compact'
+  );
   console.log('add eventSource');
   eventSource.addEventListener('message', function (event) {
     const data = JSON.parse(event.data);
@@ -595,21 +717,40 @@ function start() {
     if (data.close) {
       console.log('closing connection');
       eventSource.close();
+      closed = true;
+      maybe_done();
+      show_regressions().catch((e) => console.error(e));
     }
     if (data.info) {
       console.log('Update info');
-      document.getElementById('info').innerText = data.info;
+      const elem = document.getElementById('info');
+      if (elem) {
+        elem.innerText = data.info;
+      }
     }
 
     if (data.test_data) {
       console.log('got test data!!', data);
-      const elem = document.getElementById('info');
-      elem.parentNode.parentNode.removeChild(elem.parentNode);
+      remove_info();
 
       setTimeout(function () {
         handle_test_data(data.test_data);
       }, 0);
     }
+
+    if (data.compact) {
+      console.log('got compact data url', data.compact);
+      handle_compact(data.compact).catch((e) => console.error(e));
+    }
+
+    if (data.file_data) {
+      // keep showing progress until the stream is done.
+      console.log('got file data', Object.keys(data.file_data));
+
+      setTimeout(function () {
+        handle_test_data(data.file_data);
+      }, 0);
+    }
   });
 
   eventSource.addEventListener('close', function (event) {
@@ -622,18 +763,21 @@ function start() {
 //
 let timeoutId;
 
-function debounced_init() {
+function debounced_init(delay) {
   clearTimeout(timeoutId);
 
-  timeoutId = setTimeout(init, 1000);
+  timeoutId = setTimeout(init, delay === undefined ? 1000 : delay);
 }
 
-window.onresize = debounced_init;
+window.onresize = function () {
+  debounced_init();
+};
 
 window.init = init;
 window.start = start;
 window.process_report = process_report;
 window.process_reply = process_reply;
+window.process_compact = process_compact;
 document.getElementById('sZ').addEventListener('change', init);
 document.getElementById('sA').addEventListener('change', init);
 document.getElementById('sB').addEventListener('change', init);
@@ -0,0 +1,106 @@
+"""
+Upload pytest-json-report files of the current run to the viewer, from a GitHub
+Actions job, so that it does not have to download and parse its artifacts.
+
+This file is standalone, only the standard library is needed: the viewer serves
+it at ``/upload.py``, for the CI of other repositories to run as
+
+    curl -sSf $PYTEST_VIEWER_URL/upload.py | python3 - ./report-*.json
+
+The job needs the ``id-token: write`` permission, its OIDC token proves which
+run the reports are from. Reports are sent under their file name, name them
+after the matrix entry.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+# audience of the OIDC token of the job, ACTIONS_AUDIENCE of src/auth.py.
+OIDC_AUDIENCE = "pytest-viewer"
+
+
+def compact(report: Path) -> List[List[Any]]:
+    """
+    ``[nodeid, call, setup, teardown]`` of each test that ran, like
+    reports.compact_stream does on the server.
+    """
+    with report.open("rb") as f:
+        tests = json.load(f).get("tests", [])
+    return [
+        [
+            test["nodeid"],
+            test["call"]["duration"],
+            test["setup"]["duration"],
+            test["teardown"]["duration"],
+        ]
+        for test in tests
+        if test.get("outcome") != "skipped" and "call" in test
+    ]
+
+
+def _request(url: str, headers: Dict[str, str], data: Optional[bytes] = None):
+    req = urllib.request.Request(url, data=data, headers=headers)
+    with urllib.request.urlopen(req, timeout=300) as resp:
+        return resp.read()
+
+
+def upload(reports: List[Path], url: str, name: Optional[str] = None) -> None:
+    slug = os.environ["GITHUB_REPOSITORY"]
+    run_id = os.environ["GITHUB_RUN_ID"]
+    ref = os.environ.get("GITHUB_REF", "")
+    comps = {}
+    for report in reports:
+        comps[report.name] = compact(report)
+        print(f"{report}: {len(comps[report.name])} tests")
+    params = {}
+    if name is not None:
+        params["name"] = name
+    if ref.startswith("refs/pull/"):
+        # ref= 'refs/pull/{pr_number}/merge
+        params["pull"] = ref.split("/")[2]
+    token_url = os.environ["ACTIONS_ID_TOKEN_REQUEST_URL"]
+    separator = "&" if "?" in token_url else "?"
+    token = json.loads(
+        _request(
+            f"{token_url}{separator}{urlencode({'audience': OIDC_AUDIENCE})}",
+            {"Authorization": f"bearer {os.environ['ACTIONS_ID_TOKEN_REQUEST_TOKEN']}"},
+        )
+    )["value"]
+    body = _request(
+        f"{url.rstrip('/')}/api/upload/{slug}/{run_id}?{urlencode(params)}",
+        {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        },
+        gzip.compress(json.dumps(comps).encode()),
+    )
+    print(body.decode())
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Upload pytest reports.")
+    parser.add_argument("reports", nargs="+", type=Path)
+    parser.add_argument("--name", help="name of the upload, default: file names")
+    parser.add_argument(
+        "--url",
+        default=os.environ.get("PYTEST_VIEWER_URL"),
+        required="PYTEST_VIEWER_URL" not in os.environ,
+        help="URL of the viewer, default: $PYTEST_VIEWER_URL",
+    )
+    args = parser.parse_args(argv)
+    try:
+        upload(args.reports, args.url, args.name)
+    except urllib.error.HTTPError as e:
+        sys.exit(f"{e.code} {e.read().decode(errors='replace')}")
+
+
+if __name__ == "__main__":
+    main()
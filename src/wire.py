@@ -0,0 +1,54 @@
+"""
+Compact binary encoding of ``comp`` tables.
+
+Nodeids are the bulk of the JSON payload, and the same ones repeat in every
+matrix file, so this format stores them once in a string table, and for each
+file only an index into it plus the durations as float32 columns:
+
+    b"PTV1"
+    uint32          length of the header
+    header          utf-8 JSON, {"strings": [nodeid, ...], "files": [{"name", "n"}]}
+    padding         to a multiple of 4 bytes
+    for each file, in the order of the header:
+        uint32[n]   index of the nodeid in the string table
+        float32[n]  call duration
+        float32[n]  setup duration
+        float32[n]  teardown duration
+
+Everything is little endian and 4-byte aligned, so the client can map the
+columns with typed arrays without copying. It is meant to be served gzipped.
+"""
+import json
+import struct
+import sys
+from array import array
+from typing import Dict, List
+
+from .reports import CompItem
+
+MAGIC = b"PTV1"
+
+
+def _le(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+
+def encode_compact(tables: Dict[str, List[CompItem]]) -> bytes:
+    index: Dict[str, int] = {}
+    files = []
+    columns = []
+    for name, comp in tables.items():
+        files.append({"name": name, "n": len(comp)})
+        columns.append(
+            _le(array("I", [index.setdefault(item[0], len(index)) for item in comp]))
+        )
+        for col in (1, 2, 3):
+            columns.append(_le(array("f", [item[col] for item in comp])))
+
+    header = json.dumps({"strings": list(index), "files": files}).encode()
+    padding = b"\0" * (-len(header) % 4)
+    return b"".join(
+        [MAGIC, struct.pack("<I", len(header)), header, padding, *columns]
+    )